@@ -0,0 +1,56 @@
+# mpiexec -np 4 python -m benchmarks.build-time --channels 1 16 256 1024 --scalable
+#
+# Every rank hosts the given number of channels with a writer, and reads the
+# channels of the next rank. Times STMBuilder.build on the slowest rank, for
+# each channel count, with the default handshake and with build(scalable=True)
+# if --scalable is given. Run with several -np to see how it scales with ranks.
+
+from time import perf_counter
+from mpi4py import MPI
+
+from stm.builder import STMBuilder
+
+from .common import COMM, RANK, SIZE, finish, parser, write_results
+
+
+p = parser("STMBuilder.build time vs ranks and channel count")
+p.add_argument("--channels", type=int, nargs="+", default=[1, 16, 256])
+p.add_argument("--repeat", type=int, default=3)
+p.add_argument(
+    "--scalable", action="store_true", help="also time build(scalable=True)"
+)
+args = p.parse_args()
+
+results = []
+modes = [False, True] if args.scalable else [False]
+for scalable, n_channels in [(m, n) for m in modes for n in args.channels]:
+    times = []
+    for _ in range(args.repeat):
+        b = STMBuilder()
+        channels = [f"ch_{RANK}_{i}" for i in range(n_channels)]
+        b.create_channels(channels)
+        for channel in channels:
+            b.create_writer(channel, f"{channel}_writer")
+        prev_rank = (RANK - 1) % SIZE
+        for i in range(n_channels):
+            channel = f"ch_{prev_rank}_{i}"
+            b.create_reader(channel, f"{channel}_reader_{RANK}")
+        COMM.Barrier()
+        start = perf_counter()
+        stm = b.build(scalable)
+        times.append(COMM.allreduce(perf_counter() - start, op=MPI.MAX))
+        stm.start()
+        finish(stm)
+    if RANK == 0:
+        results.append(
+            {
+                "scalable": scalable,
+                "ranks": SIZE,
+                "channels_per_rank": n_channels,
+                "channels": n_channels * SIZE,
+                "min_s": min(times),
+                "mean_s": sum(times) / len(times),
+            }
+        )
+
+write_results("build-time", args, results)
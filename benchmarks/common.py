@@ -0,0 +1,104 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+from typing import Any
+from mpi4py import MPI
+
+from stm.stm import _STM
+
+
+COMM = MPI.COMM_WORLD
+RANK = COMM.Get_rank()
+SIZE = COMM.Get_size()
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def parser(description: str) -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument(
+        "--out",
+        help="JSON file to write the results to, "
+        "defaults to benchmarks/results/<name>-np<ranks>-<commit>.json",
+    )
+    p.add_argument(
+        "--numpy",
+        action="store_true",
+        help="use NumPy arrays as payloads, sent out-of-band, instead of bytes",
+    )
+    return p
+
+
+def payload(size: int, use_numpy: bool = False) -> Any:
+    if use_numpy:
+        import numpy
+
+        return numpy.zeros(size, dtype=numpy.uint8)
+    return bytes(size)
+
+
+def git_commit() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(__file__),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+# stops the instance and waits for its listener, so that the next
+# instance of the benchmark starts with nothing in flight
+def finish(stm: _STM):
+    stm.stop()
+    stm._listening_thread.join()
+
+
+# the resident set size of this process, in bytes
+def rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        # the peak, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# writes the results gathered on rank 0, along with what is needed to compare
+# them across commits and machines, and prints them
+def write_results(name: str, args: argparse.Namespace, results: list[dict]):
+    if RANK != 0:
+        return
+    commit = git_commit()
+    out = args.out
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out = os.path.join(
+            RESULTS_DIR, f"{name}-np{SIZE}-{(commit or 'unknown')[:10]}.json"
+        )
+    report = {
+        "benchmark": name,
+        "commit": commit,
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "ranks": SIZE,
+        "host": platform.node(),
+        "python": sys.version.split()[0],
+        "mpi": MPI.Get_library_version().strip(),
+        "args": {k: v for k, v in vars(args).items() if k != "out"},
+        "results": results,
+    }
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    for result in results:
+        print(json.dumps(result))
+    print(f"results written to {out}")
@@ -0,0 +1,43 @@
+# python -m benchmarks.compare benchmarks/results/put-throughput-np2-<old>.json \
+#     benchmarks/results/put-throughput-np2-<new>.json
+#
+# Prints the results of two runs of a benchmark side by side, with the
+# new/old ratio of every timing and rate.
+
+import argparse
+import json
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    p = argparse.ArgumentParser(description="compare two benchmark runs")
+    p.add_argument("old")
+    p.add_argument("new")
+    args = p.parse_args()
+    old, new = load(args.old), load(args.new)
+    if old["benchmark"] != new["benchmark"]:
+        raise SystemExit(f"{old['benchmark']} and {new['benchmark']} differ")
+    print(f"{old['benchmark']}: {old['commit']} -> {new['commit']}")
+    for old_result, new_result in zip(old["results"], new["results"]):
+        params, ratios = [], []
+        for key, old_value in old_result.items():
+            new_value = new_result.get(key)
+            measured = key.endswith(("_s", "seconds", "_per_s"))
+            if not measured:
+                params.append(f"{key}={old_value}")
+            elif old_value and isinstance(new_value, (int, float)):
+                ratio = new_value / old_value
+                ratios.append(
+                    f"{key} {old_value:.4g} -> {new_value:.4g} (x{ratio:.2f})"
+                )
+        print("  " + " ".join(params))
+        for ratio in ratios:
+            print("    " + ratio)
+
+
+if __name__ == "__main__":
+    main()
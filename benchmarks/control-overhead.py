@@ -0,0 +1,82 @@
+# mpiexec -np 3 python -m benchmarks.control-overhead --control-delay 0 0.001
+#
+# Rank 0 hosts the channel, the writer is on rank 1 and the reader on the
+# last rank (roles share ranks with fewer ranks). The writer only advances
+# and the reader only consumes, one timestamp at a time, so every message is
+# a control message. Reports the rate of advances seen by the reader and of
+# consumes seen by the channel, and the control messages actually sent, for
+# each control_delay.
+
+from time import perf_counter, sleep
+
+from stm.builder import STMBuilder
+
+from .common import COMM, RANK, SIZE, finish, parser, write_results
+
+
+p = parser("consume/advance control overhead")
+p.add_argument("--steps", type=int, default=10000)
+p.add_argument(
+    "--control-delay",
+    type=float,
+    nargs="+",
+    default=[0, 0.001],
+    help="0 sends every advance and consume",
+)
+p.add_argument("--coalesce-advances", action="store_true")
+args = p.parse_args()
+
+writer_rank = 1 if SIZE > 1 else 0
+reader_rank = SIZE - 1
+
+results = []
+for delay in args.control_delay:
+    control_delay = delay or None
+    b = STMBuilder()
+    if RANK == 0:
+        b.create_channels(["ch"], coalesce_advances=args.coalesce_advances)
+    if RANK == writer_rank:
+        b.create_writer("ch", "writer", control_delay=control_delay)
+    if RANK == reader_rank:
+        b.create_reader("ch", "reader", control_delay=control_delay)
+    stm = b.build()
+    stm.start()
+
+    COMM.Barrier()
+    start = perf_counter()
+    if RANK == writer_rank:
+        writer = stm.get_writer("writer")
+        for ts in range(1, args.steps + 1):
+            writer.advance_until(ts)
+        writer.flush()
+    if RANK == reader_rank:
+        reader = stm.get_reader("reader")
+        reader.get(args.steps - 1, wait=True)
+        advance_s = perf_counter() - start
+        for ts in range(1, args.steps + 1):
+            reader.consume_until(ts)
+        reader.flush()
+    if RANK == 0:
+        # polls the channel, there is no wait on consumes
+        channel = stm._local_channels["ch"]
+        while channel.stats()["keeptime"] < args.steps:
+            sleep(1e-4)
+        total_s = perf_counter() - start
+    sent = COMM.gather(stm.stats()["messages_sent"], root=0)
+    advance_s = COMM.bcast(advance_s if RANK == reader_rank else None, reader_rank)
+    if RANK == 0:
+        results.append(
+            {
+                "control_delay": control_delay,
+                "coalesce_advances": args.coalesce_advances,
+                "steps": args.steps,
+                "advance_s": advance_s,
+                "advances_per_s": args.steps / advance_s,
+                "advance_and_consume_s": total_s,
+                "messages_sent": sum(sent),
+                "messages_per_step": sum(sent) / args.steps / 2,
+            }
+        )
+    finish(stm)
+
+write_results("control-overhead", args, results)
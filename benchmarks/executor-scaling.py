@@ -0,0 +1,76 @@
+# mpiexec -np 4 python -m benchmarks.executor-scaling --channels 16 --workers 1 2 4 8
+#
+# Rank 0 hosts every channel, the other ranks write to and read from all of
+# them, so rank 0 publishes every item to every other rank. Reports how long
+# the items take to reach all the readers with the single listener thread,
+# and with the "executor" mode for each number of workers.
+
+from time import perf_counter
+from mpi4py import MPI
+
+from stm.builder import STMBuilder
+
+from .common import COMM, RANK, SIZE, finish, parser, payload, write_results
+
+
+p = parser("listener thread vs executor mode on a rank hosting many channels")
+p.add_argument("--channels", type=int, default=16)
+p.add_argument("--items", type=int, default=200, help="items per writer")
+p.add_argument("--size", type=int, default=64 * 1024, help="item size (bytes)")
+p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+args = p.parse_args()
+
+
+def run(listening_mode: str, n_workers: int | None = None) -> float:
+    channels = [f"ch{i}" for i in range(args.channels)]
+    b = STMBuilder()
+    if RANK == 0:
+        b.create_channels(channels)
+    else:
+        for channel in channels:
+            b.create_writer(channel, f"{channel}_writer_{RANK}")
+            b.create_reader(channel, f"{channel}_reader_{RANK}")
+    stm = b.build()
+    stm.start(listening_mode, n_workers)
+    item = payload(args.size, args.numpy)
+
+    COMM.Barrier()
+    start = perf_counter()
+    if RANK > 0:
+        writers = [stm.get_writer(f"{channel}_writer_{RANK}") for channel in channels]
+        for ts in range(1, args.items + 1):
+            for writer in writers:
+                writer.put(ts * SIZE + RANK, item)
+        # no writer puts at `until - 1`, so getting it returns once every
+        # writer advanced past it, which is after all their items arrived
+        until = (args.items + 1) * SIZE + 1
+        for writer in writers:
+            writer.advance_until(until)
+        for channel in channels:
+            stm.get_reader(f"{channel}_reader_{RANK}").get(until - 1, wait=True)
+    elapsed = COMM.allreduce(perf_counter() - start, op=MPI.MAX)
+    finish(stm)
+    return elapsed
+
+
+if SIZE < 2:
+    raise SystemExit("needs at least 2 ranks")
+
+results = []
+n_items = args.channels * args.items * (SIZE - 1)
+for mode, n_workers in [("thread", None)] + [("executor", n) for n in args.workers]:
+    elapsed = run(mode, n_workers)
+    results.append(
+        {
+            "mode": mode,
+            "workers": n_workers,
+            "channels": args.channels,
+            "writer_ranks": SIZE - 1,
+            "size": args.size,
+            "items": n_items,
+            "seconds": elapsed,
+            "items_per_s": n_items / elapsed,
+        }
+    )
+
+write_results("executor-scaling", args, results)
@@ -0,0 +1,67 @@
+# mpiexec -np 9 python -m benchmarks.fanout --readers 1 2 4 8 --fanout 2
+#
+# Rank 0 hosts the channel and writes to it, ranks 1..n each have a reader.
+# Times how long publish_data takes to deliver the items to all the reader
+# ranks, for each number of reader ranks, with and without a relay tree.
+
+from time import perf_counter
+from mpi4py import MPI
+
+from stm.builder import STMBuilder
+
+from .common import COMM, RANK, SIZE, finish, parser, payload, write_results
+
+
+p = parser("publish_data fan-out vs reader count")
+p.add_argument("--readers", type=int, nargs="+", default=None)
+p.add_argument("--fanout", type=int, nargs="*", default=[])
+p.add_argument("--size", type=int, default=4096)
+p.add_argument("--items", type=int, default=1000)
+args = p.parse_args()
+
+if SIZE < 2:
+    raise SystemExit("needs at least 2 ranks")
+reader_counts = args.readers or [n for n in (1, 2, 4, 8, 16, 32) if n < SIZE]
+if max(reader_counts) >= SIZE:
+    raise SystemExit(f"at most {SIZE - 1} reader ranks with {SIZE} ranks")
+
+results = []
+item = payload(args.size, args.numpy)
+for n_readers in reader_counts:
+    for fanout in [None] + args.fanout:
+        b = STMBuilder()
+        if RANK == 0:
+            b.create_channels(["ch"], fanout=fanout)
+            b.create_writer("ch", "writer")
+        elif RANK <= n_readers:
+            b.create_reader("ch", f"reader_{RANK}")
+        stm = b.build()
+        stm.start()
+
+        until = args.items + 1
+        COMM.Barrier()
+        start = perf_counter()
+        if RANK == 0:
+            writer = stm.get_writer("writer")
+            for ts in range(args.items):
+                writer.put(ts, item)
+            writer.advance_until(until)
+        elif RANK <= n_readers:
+            stm.get_reader(f"reader_{RANK}").get(until - 1, wait=True)
+        # the slowest reader rank sets the time
+        elapsed = COMM.reduce(perf_counter() - start, op=MPI.MAX, root=0)
+        if RANK == 0:
+            results.append(
+                {
+                    "reader_ranks": n_readers,
+                    "fanout": fanout,
+                    "size": args.size,
+                    "items": args.items,
+                    "seconds": elapsed,
+                    "items_per_s": args.items / elapsed,
+                    "deliveries_per_s": args.items * n_readers / elapsed,
+                }
+            )
+        finish(stm)
+
+write_results("fanout", args, results)
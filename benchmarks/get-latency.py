@@ -0,0 +1,83 @@
+# mpiexec -np 3 python -m benchmarks.get-latency --size 64
+#
+# Ping-pong through two channels hosted on rank 0: the last rank waits for
+# each item put on "ping" by rank 1, and answers with an item on "pong".
+# The latency of a get after a put is half of the round trip, which needs no
+# synchronized clocks. With fewer ranks, rank 0 answers, and on a single rank
+# it answers from a thread.
+
+import threading
+from time import perf_counter
+
+from stm.builder import STMBuilder
+
+from .common import COMM, RANK, SIZE, finish, parser, payload, write_results
+
+
+p = parser("get latency after put")
+p.add_argument("--size", type=int, default=64)
+p.add_argument("--items", type=int, default=1000)
+p.add_argument("--warmup", type=int, default=50)
+args = p.parse_args()
+
+pinger = 1 if SIZE > 1 else 0
+ponger = SIZE - 1 if SIZE > 2 else 0
+
+b = STMBuilder()
+if RANK == 0:
+    b.create_channels(["ping", "pong"])
+if RANK == pinger:
+    b.create_writer("ping", "ping_writer")
+    b.create_reader("pong", "pong_reader")
+if RANK == ponger:
+    b.create_reader("ping", "ping_reader")
+    b.create_writer("pong", "pong_writer")
+stm = b.build()
+stm.start()
+
+item = payload(args.size, args.numpy)
+n = args.warmup + args.items
+round_trips = []
+
+
+def pong():
+    reader, writer = stm.get_reader("ping_reader"), stm.get_writer("pong_writer")
+    for ts in range(1, n + 1):
+        reader.get(ts, wait=True)
+        writer.put(ts, b"")
+        reader.consume_until(ts)
+
+
+COMM.Barrier()
+if RANK == ponger:
+    ponging = threading.Thread(target=pong)
+    ponging.start()
+if RANK == pinger:
+    writer, reader = stm.get_writer("ping_writer"), stm.get_reader("pong_reader")
+    for ts in range(1, n + 1):
+        start = perf_counter()
+        writer.put(ts, item)
+        reader.get(ts, wait=True)
+        round_trips.append(perf_counter() - start)
+        reader.consume_until(ts)
+if RANK == ponger:
+    ponging.join()
+COMM.Barrier()
+finish(stm)
+
+round_trips = COMM.bcast(round_trips, root=pinger)
+results = []
+if round_trips:
+    latencies = sorted(rt / 2 for rt in round_trips[args.warmup :])
+    results.append(
+        {
+            "size": args.size,
+            "items": len(latencies),
+            "mean_s": sum(latencies) / len(latencies),
+            "p50_s": latencies[len(latencies) // 2],
+            "p90_s": latencies[int(len(latencies) * 0.9)],
+            "p99_s": latencies[int(len(latencies) * 0.99)],
+            "max_s": latencies[-1],
+        }
+    )
+write_results("get-latency", args, results)
@@ -0,0 +1,102 @@
+# mpiexec -np 3 python -m benchmarks.link-latency --values 8 --rate 1000
+#
+# Ping-pong of small typed items at a steady rate, through two typed channels
+# hosted on rank 0, with and without persistent links. Rank 1 puts an item on
+# "ping" every 1/rate seconds, the last rank answers each one on "pong". The
+# latency of a get after a put is half of the round trip. With fewer ranks,
+# rank 0 answers, and on a single rank it answers from a thread (and no link
+# is set up, as every connection is local).
+
+import threading
+import time
+from time import perf_counter
+
+from stm.builder import STMBuilder
+
+from .common import COMM, RANK, SIZE, finish, parser, write_results
+
+
+p = parser("get latency of small typed items at a steady rate")
+p.add_argument("--values", type=int, default=8, help="float64 values per item")
+p.add_argument("--rate", type=float, default=1000, help="pings per second")
+p.add_argument("--items", type=int, default=2000)
+p.add_argument("--warmup", type=int, default=100)
+args = p.parse_args()
+
+pinger = 1 if SIZE > 1 else 0
+ponger = SIZE - 1 if SIZE > 2 else 0
+n = args.warmup + args.items
+
+
+def run(persistent: bool) -> list[float]:
+    import numpy
+
+    b = STMBuilder()
+    if RANK == 0:
+        b.create_channels(
+            ["ping", "pong"],
+            dtype="f8",
+            shape=(args.values,),
+            capacity=64,
+            persistent=persistent,
+        )
+    if RANK == pinger:
+        b.create_writer("ping", "ping_writer")
+        b.create_reader("pong", "pong_reader")
+    if RANK == ponger:
+        b.create_reader("ping", "ping_reader")
+        b.create_writer("pong", "pong_writer")
+    stm = b.build()
+    stm.start()
+    item = numpy.zeros(args.values)
+    round_trips = []
+
+    def pong():
+        reader, writer = stm.get_reader("ping_reader"), stm.get_writer("pong_writer")
+        for ts in range(1, n + 1):
+            item, _ = reader.get(ts, wait=True)
+            writer.put(ts, item)
+            reader.consume_until(ts)
+
+    COMM.Barrier()
+    if RANK == ponger:
+        ponging = threading.Thread(target=pong)
+        ponging.start()
+    if RANK == pinger:
+        writer, reader = stm.get_writer("ping_writer"), stm.get_reader("pong_reader")
+        period = 1 / args.rate
+        next_ping = time.monotonic()
+        for ts in range(1, n + 1):
+            # steady rate: pings are not sent back to back
+            time.sleep(max(0.0, next_ping - time.monotonic()))
+            next_ping += period
+            start = perf_counter()
+            writer.put(ts, item)
+            reader.get(ts, wait=True)
+            round_trips.append(perf_counter() - start)
+            reader.consume_until(ts)
+    if RANK == ponger:
+        ponging.join()
+    COMM.Barrier()
+    finish(stm)
+    return COMM.bcast(round_trips, root=pinger)
+
+
+results = []
+for persistent in (False, True):
+    round_trips = run(persistent)
+    latencies = sorted(rt / 2 for rt in round_trips[args.warmup :])
+    results.append(
+        {
+            "persistent": persistent,
+            "values": args.values,
+            "rate": args.rate,
+            "items": len(latencies),
+            "mean_s": sum(latencies) / len(latencies),
+            "p50_s": latencies[len(latencies) // 2],
+            "p90_s": latencies[int(len(latencies) * 0.9)],
+            "p99_s": latencies[int(len(latencies) * 0.99)],
+            "max_s": latencies[-1],
+        }
+    )
+write_results("link-latency", args, results)
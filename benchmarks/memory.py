@@ -0,0 +1,67 @@
+# mpiexec -np 2 python -m benchmarks.memory --windows 10 100 1000 --size 65536
+#
+# Rank 0 hosts the channel and writes to it, the reader on the last rank
+# consumes with a lag of `window` timestamps behind the latest item. Reports
+# the items retained by the reader's store and the memory of every rank once
+# the window is full, for each window.
+
+from stm.builder import STMBuilder
+
+from .common import COMM, RANK, SIZE, finish, parser, payload, rss, write_results
+
+
+p = parser("memory vs keeptime window")
+p.add_argument("--windows", type=int, nargs="+", default=[10, 100, 1000])
+p.add_argument("--size", type=int, default=65536)
+args = p.parse_args()
+
+reader_rank = SIZE - 1
+
+b = STMBuilder()
+if RANK == 0:
+    b.create_channels(["ch"])
+    b.create_writer("ch", "writer")
+if RANK == reader_rank:
+    b.create_reader("ch", "reader")
+stm = b.build()
+stm.start()
+
+results = []
+base = 0
+for window in args.windows:
+    # the window is filled twice, so that consumed items were freed
+    n_items = 2 * window
+    COMM.Barrier()
+    baseline = rss()
+    if RANK == 0:
+        writer = stm.get_writer("writer")
+        for i in range(n_items):
+            # a new payload each time, so that every retained item costs memory
+            writer.put(base + i, payload(args.size, args.numpy))
+        writer.advance_until(base + n_items)
+    retained = None
+    if RANK == reader_rank:
+        reader = stm.get_reader("reader")
+        for i in range(n_items):
+            reader.get(base + i, wait=True)
+            if i >= window:
+                reader.consume_until(base + i - window)
+        retained = stm.stats()["channels"]["ch"]["readers"]["items_retained"]
+    rss_growth = COMM.gather(rss() - baseline, root=0)
+    retained = COMM.bcast(retained, root=reader_rank)
+    if RANK == 0:
+        results.append(
+            {
+                "window": window,
+                "size": args.size,
+                "items_retained": retained,
+                "rss_growth_bytes": rss_growth,
+                "payload_bytes_retained": retained * args.size,
+            }
+        )
+    if RANK == reader_rank:
+        reader.consume_until(base + n_items)
+    base += n_items
+
+finish(stm)
+write_results("memory", args, results)
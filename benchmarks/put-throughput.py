@@ -0,0 +1,64 @@
+# mpiexec -np 2 python -m benchmarks.put-throughput --sizes 64 1024 65536 1048576
+#
+# Rank 0 hosts the channel and its only reader, every other rank writes to
+# it (rank 0 itself on a single rank). Times how long the items of all the
+# writers take to be stored by the reader, for each payload size.
+
+from time import perf_counter
+
+from stm.builder import STMBuilder
+
+from .common import COMM, RANK, SIZE, finish, parser, payload, write_results
+
+
+p = parser("put throughput vs payload size")
+p.add_argument("--sizes", type=int, nargs="+", default=[64, 1024, 16384, 262144])
+p.add_argument("--items", type=int, default=2000, help="items per writer and size")
+p.add_argument("--batch-size", type=int, default=None)
+args = p.parse_args()
+
+writer_ranks = list(range(1, SIZE)) if SIZE > 1 else [0]
+
+b = STMBuilder()
+if RANK == 0:
+    b.create_channels(["ch"])
+    b.create_reader("ch", "reader")
+if RANK in writer_ranks:
+    b.create_writer("ch", f"writer_{RANK}", batch_size=args.batch_size)
+stm = b.build()
+stm.start()
+
+results = []
+base = 0
+for size in args.sizes:
+    item = payload(size, args.numpy)
+    # items of writer r are at base + i * SIZE + r, nothing is put at until - 1
+    until = base + (args.items + 1) * SIZE
+    COMM.Barrier()
+    start = perf_counter()
+    if RANK in writer_ranks:
+        writer = stm.get_writer(f"writer_{RANK}")
+        for i in range(args.items):
+            writer.put(base + i * SIZE + RANK, item)
+        writer.advance_until(until)
+    if RANK == 0:
+        reader = stm.get_reader("reader")
+        reader.get(until - 1, wait=True)
+        elapsed = perf_counter() - start
+        reader.consume_until(until)
+        n_items = args.items * len(writer_ranks)
+        results.append(
+            {
+                "size": size,
+                "writers": len(writer_ranks),
+                "items": n_items,
+                "seconds": elapsed,
+                "items_per_s": n_items / elapsed,
+                "mb_per_s": n_items * size / elapsed / 1e6,
+            }
+        )
+    base = until
+    COMM.Barrier()
+
+finish(stm)
+write_results("put-throughput", args, results)
@@ -43,6 +43,5 @@ with b.build() as stm:
         reader.consume_until(3)
         print(f"({rank}) {reader.data._data}")
         print(f"({rank}) get(7)={reader.get(7)}")  # null and still possible
-        print(f"({rank}) sleeping...")
-        sleep(0.6)
-        print(f"({rank}) get(7)={reader.get(7)}")  # not null
+        print(f"({rank}) waiting...")
+        print(f"({rank}) get(7)={reader.get(7, wait=True)}")  # not null
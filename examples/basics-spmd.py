@@ -1,6 +1,5 @@
 # mpiexec -np 3 python -m examples.basics-spmd
 
-from time import sleep
 from stm.builder import STMBuilder
 from mpi4py import MPI
 
@@ -20,6 +19,5 @@ with b.build() as stm:
         writer.put(1, "HELLO, THIS IS DATA")
     else:
         reader = stm.get_reader(f"ch1_reader_{rank}")
-        sleep(0.1)
-        print(f"({rank}) {reader.get(1)}")
+        print(f"({rank}) {reader.get(1, wait=True)}")
         print(f"({rank}) {reader.get(2)}")
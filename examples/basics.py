@@ -15,6 +15,6 @@ reader = stm.get_reader("ch1_reader")
 writer = stm.get_writer("ch1_writer")
 
 writer.put(1, "HELLO, THIS IS DATA")
-print(reader.get(1))
+print(reader.get(1, wait=True))
 
 stm.stop()
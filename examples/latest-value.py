@@ -0,0 +1,35 @@
+# mpiexec -np 1 python -m examples.latest-value
+
+import threading
+from time import sleep
+from stm import STMBuilder
+
+builder = (
+    STMBuilder()
+    .create_channels(["state"], keep_last=1)
+    .create_reader("state", "state_reader")
+    .create_writer("state", "state_writer")
+)
+stm = builder.build()
+stm.start("thread")
+
+reader = stm.get_reader("state_reader")
+writer = stm.get_writer("state_writer")
+
+# waits for 3, which will be dropped
+waiting = threading.Thread(target=lambda: print(reader.get(3, wait=True, timeout=5)))
+waiting.start()
+sleep(0.1)
+
+writer.put(5, "state(5)")
+# older than the item held, so it is not stored
+writer.put(3, "state(3)")
+print(reader.get_last())  # ('state(5)', 5)
+print(reader.get_at_or_before(4))  # (None, None)
+
+# the get waiting on the dropped timestamp returns once the writer advances
+# past it, with no item
+writer.advance_until(10)
+waiting.join()  # prints (None, False)
+
+stm.stop()
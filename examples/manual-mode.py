@@ -13,19 +13,15 @@ rank = comm.Get_rank()
 
 class PDESEngine:
     def __init__(self, stm: _STM):
-        self.msg_request = None
         self.stm = stm
         self.stm.start("manual")
 
     def process_messages(self):
-        if not self.msg_request:
-            self.msg_request = self.stm.receive_message()
-        ready = self.msg_request.get_status()
-        while ready:
-            msg = self.msg_request.wait()
-            self.stm.process_message(msg)
-            self.msg_request = self.stm.receive_message()
-            ready = self.msg_request.get_status()
+        # polls, and processes whatever has arrived as a single batch
+        msgs = self.stm.receive_messages(timeout=0)
+        while msgs:
+            self.stm.process_messages(msgs)
+            msgs = self.stm.receive_messages(timeout=0)
 
 
 b = STMBuilder()
@@ -1,12 +1,38 @@
+from collections.abc import Iterable
+import itertools
+import logging
+import pickle
 from mpi4py import MPI
+from typing import Any, Literal
 
-from .channel import _Channel
-from .stm import _STM, _Reader, _Writer
+from .channel import shard_name, _Channel
+from .checkpoint import read_checkpoint, Checkpoint_Record
+from .data import _Ring_Spec, _Subscription
+from .links import link_tag, _Receive_Link, _Send_Link, READER_LINK, WRITER_LINK
+from .shm import _Ring_Reader, _Ring_Writer
+from .directory import (
+    channel_key,
+    directory_rank,
+    exchange,
+    exchange_records,
+    _Channel_Directory,
+    DUPLICATE,
+    UNKNOWN,
+)
+from .stm import (
+    _STM,
+    _Local_Readers,
+    _Reader,
+    _Sharded_Reader,
+    _Sharded_Writer,
+    _Writer,
+)
 
 from .log import logger
 from .messaging import (
     _Message_STM_Channels_Init,
 )
+from .transport import _STM_Comm
 
 COMM = MPI.COMM_WORLD
 RANK = COMM.Get_rank()
@@ -18,57 +44,507 @@ class STMBuilder:
         self._obj = _STM()
         self._channel_reader_names: dict[str, list[str]] = {}
         self._channel_writer_names: dict[str, list[str]] = {}
+        self._reader_control_delay: dict[str, float | None] = {}
+        self._reader_subscriptions: dict[str, _Subscription | None] = {}
+        # arguments of the _Local_Readers of each channel,
+        # (memory_budget, ring, keep_last)
+        self._channel_stores: dict[
+            str, tuple[int | None, _Ring_Spec | None, int | None]
+        ] = {}
+        # sharded channels declared on this rank -> (shards, arguments of _Channel)
+        self._sharded_channels: dict[str, tuple[int, tuple]] = {}
+        # arguments of the writers, to create one per shard of sharded channels
+        self._writer_options: dict[str, dict] = {}
+        # sharded readers -> (channel name, names of their reader per shard)
+        self._sharded_reader_names: dict[str, tuple[str, list[str]]] = {}
+        # names of the connections declared on this rank, in declaration order
+        self._reader_names: list[str] = []
+        self._writer_names: list[str] = []
+        self._reader_ids: dict[str, int] = {}
+        self._writer_ids: dict[str, int] = {}
+        self._restore_path: str | None = None
+        self._scalable = False
+        # persistent links set up by this rank, the tags of the links it
+        # sends on or receives from
+        self._link_indices = itertools.count()
 
-    def create_channels(self, channels: list[str]):
-        # todo: check duplicates
+    def create_channels(
+        self,
+        channels: list[str],
+        fanout: int | None = None,
+        transport: Literal["mpi", "shm"] = "mpi",
+        coalesce_advances: bool = False,
+        memory_budget: int | None = None,
+        shards: int = 1,
+        dtype: Any = None,
+        shape: tuple[int, ...] = (),
+        capacity: int | None = None,
+        persistent: bool = False,
+        keep_last: int | None = None,
+    ):
+        if fanout is not None and fanout < 1:
+            raise ValueError("fanout must be at least 1")
+        if transport not in ("mpi", "shm"):
+            raise ValueError("Invalid transport")
+        if memory_budget is not None and memory_budget < 0:
+            raise ValueError("memory_budget must not be negative")
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        ring = None
+        if dtype is not None:
+            ring = self._ring_spec(dtype, shape, capacity, memory_budget)
+        if persistent:
+            if ring is None:
+                raise ValueError("only typed channels can be persistent")
+            if fanout is not None or transport != "mpi":
+                raise ValueError(
+                    "persistent channels send to every reader rank over MPI"
+                )
+            ring.persistent = True
+        if keep_last is not None:
+            if keep_last < 1:
+                raise ValueError("keep_last must be at least 1")
+            if ring is not None:
+                raise ValueError("typed channels cannot have a keep_last")
         for channel in channels:
-            self._obj._local_channels[channel] = _Channel(channel)
+            if channel in self._obj._local_channels or (
+                channel in self._sharded_channels
+            ):
+                raise ValueError(f"Duplicate channel {channel!r}")
+        if len(set(channels)) != len(channels):
+            raise ValueError("Duplicate channel names")
+        if shards > 1:
+            # the shards are created at build time, on the ranks hosting them
+            options = (
+                fanout,
+                transport,
+                coalesce_advances,
+                memory_budget,
+                ring,
+                keep_last,
+            )
+            for channel in channels:
+                self._sharded_channels[channel] = (shards, options)
+            return self
+        for channel in channels:
+            self._obj._local_channels[channel] = _Channel(
+                channel,
+                fanout,
+                transport,
+                coalesce_advances,
+                memory_budget,
+                ring,
+                keep_last,
+            )
             self._obj._channel_rank[channel] = RANK
         return self
 
-    def create_reader(self, channel_name: str, reader_name: str):
+    def _ring_spec(
+        self,
+        dtype: Any,
+        shape: tuple[int, ...],
+        capacity: int | None,
+        memory_budget: int | None,
+    ) -> _Ring_Spec:
+        import numpy
+
+        dtype = numpy.dtype(dtype)
+        shape = tuple(shape)
+        if dtype.hasobject or dtype.fields is not None or len(dtype.str) > 8:
+            raise ValueError(f"dtype {dtype} is not a plain numeric dtype")
+        if len(shape) > _Ring_Spec.MAX_DIMS or any(dim < 0 for dim in shape):
+            raise ValueError(
+                f"shape must have at most {_Ring_Spec.MAX_DIMS} non-negative dimensions"
+            )
+        if capacity is None or capacity < 1:
+            raise ValueError("typed channels need a capacity of at least 1")
+        if memory_budget is not None:
+            raise ValueError("typed channels cannot have a memory_budget")
+        return _Ring_Spec(dtype.str, shape, capacity)
+
+    def create_reader(
+        self,
+        channel_name: str,
+        reader_name: str,
+        control_delay: float | None = None,
+        stride: int | None = None,
+        window: tuple[int, int] | None = None,
+        latest: bool = False,
+    ):
+        subscription = _Subscription.of(stride, window, latest)
+        self._reader_control_delay[reader_name] = control_delay
+        self._reader_subscriptions[reader_name] = subscription
+        self._reader_names.append(reader_name)
         channel_is_local = (
             channel_name in self._obj._local_channels
             and channel_name in self._obj._channel_rank
         )
         if channel_is_local:
-            reader = _Reader(reader_name, channel_name, RANK)
-            channel = self._obj._local_channels[channel_name]
-            channel.local_readers.add(reader)
-            channel.set_reader_keeptime(reader_name, 0)
-            self._obj._readers_by_id[reader_name] = reader
+            self._create_local_reader(channel_name, reader_name)
         else:
             # we don't know the rank at this point, so save for later
             self._channel_reader_names.setdefault(channel_name, [])
             self._channel_reader_names[channel_name].append(reader_name)
         return self
 
-    def create_writer(self, channel_name: str, writer_name: str):
+    def _create_local_reader(self, channel_name: str, reader_name: str):
+        channel = self._obj._local_channels[channel_name]
+        reader = _Reader(
+            reader_name,
+            channel_name,
+            RANK,
+            channel.local_readers.data,
+            self._reader_control_delay[reader_name],
+        )
+        reader.subscription = self._reader_subscriptions[reader_name]
+        channel.local_readers.add(reader)
+        self._obj._readers_by_id[reader_name] = reader
+
+    def create_writer(
+        self,
+        channel_name: str,
+        writer_name: str,
+        batch_size: int | None = None,
+        batch_delay: float | None = None,
+        max_pending: int | None = None,
+        max_pending_bytes: int | None = None,
+        block_when_full: bool = True,
+        control_delay: float | None = None,
+    ):
         channel_is_local = (
             channel_name in self._obj._local_channels
             and channel_name in self._obj._channel_rank
         )
-        if channel_is_local:
-            channel = self._obj._local_channels[channel_name]
-            channel.set_writer_advancetime(writer_name, 0)
-            writer = _Writer(writer_name, channel_name, RANK)
-            self._obj._writers_by_id[writer_name] = writer
-        else:
+        options = dict(
+            batch_size=batch_size,
+            batch_delay=batch_delay,
+            max_pending=max_pending,
+            max_pending_bytes=max_pending_bytes,
+            block_when_full=block_when_full,
+            control_delay=control_delay,
+        )
+        self._writer_options[writer_name] = options
+        # the channel rank of remote writers is filled in at build time
+        writer = _Writer(
+            writer_name, channel_name, RANK if channel_is_local else None, **options
+        )
+        self._obj._writers_by_id[writer_name] = writer
+        self._writer_names.append(writer_name)
+        if not channel_is_local:
             # we don't know the rank at this point, so save for later
             self._channel_writer_names.setdefault(channel_name, [])
             self._channel_writer_names[channel_name].append(writer_name)
         return self
 
+    # the state of the checkpoint in the directory `path` is loaded by .build,
+    # once the channels and connections declared on every rank are set up
+    def restore(self, path: str):
+        self._restore_path = path
+        return self
+
+    def _restore(self, path: str):
+        def mismatch():
+            return ValueError(
+                f"{path} was checkpointed with other channels or connections"
+            )
+
+        channel_names = sorted(self._obj._channel_ids, key=self._obj._channel_ids.get)
+        readers = None
+        for kind, ts, obj in read_checkpoint(path, RANK):
+            if kind == Checkpoint_Record.HEADER:
+                if obj["ranks"] != SIZE or obj["channels"] != channel_names:
+                    raise mismatch()
+            elif kind == Checkpoint_Record.CHANNEL:
+                name, readers_keeptime, writers_advancetime = obj
+                channel = self._obj._local_channels.get(name)
+                if (
+                    channel is None
+                    or readers_keeptime.keys() != set(channel._readers_keeptime)
+                    or writers_advancetime.keys()
+                    != set(channel._writers_advancetime)
+                ):
+                    raise mismatch()
+                channel._readers_keeptime.update(readers_keeptime)
+                channel._writers_advancetime.update(writers_advancetime)
+            elif kind == Checkpoint_Record.READERS:
+                name, times = obj
+                if name in self._obj._local_channels:
+                    readers = self._obj._local_channels[name].local_readers
+                else:
+                    channel_id = self._obj._channel_ids[name]
+                    readers = self._obj._readers_by_channel.get(channel_id)
+                if readers is None or times.keys() != {r.name for r in readers}:
+                    raise mismatch()
+                for reader in readers:
+                    reader.keeptime, reader.channel_advancetime = times[reader.name]
+                    readers.data.consume(reader.name, reader.keeptime)
+            elif kind == Checkpoint_Record.ITEM:
+                readers.data[ts] = obj
+            elif kind == Checkpoint_Record.WRITERS:
+                if obj.keys() != self._obj._writers_by_id.keys():
+                    raise mismatch()
+                for name, advancetime in obj.items():
+                    self._obj._writers_by_id[name].advancetime = advancetime
+
     def _distribute_channel_ranks(self):
-        # share all channel locations (source ranks)
+        # share all channel locations (source ranks), and assign dense ids to
+        # channels, readers and writers, in rank and then declaration order
         channel_msgs = _Message_STM_Channels_Init(
-            channels=list(self._obj._local_channels.keys()), source_rank=RANK
+            channels=list(self._obj._local_channels.keys()),
+            source_rank=RANK,
+            n_readers=len(self._reader_names),
+            n_writers=len(self._writer_names),
+            memory_budgets=[
+                channel.memory_budget
+                for channel in self._obj._local_channels.values()
+            ],
+            rings=[channel.ring for channel in self._obj._local_channels.values()],
+            keep_lasts=[
+                channel.keep_last for channel in self._obj._local_channels.values()
+            ],
+            sharded=[
+                (channel_name, shards, options)
+                for channel_name, (shards, options) in self._sharded_channels.items()
+            ],
         )
         rank_ready_messages = COMM.allgather(channel_msgs)
         logger.debug(f"({RANK}) ready msgs = {rank_ready_messages}")
+        errors = []
+        first_reader_id = first_writer_id = 0
         for msg in rank_ready_messages:
-            for channel_name in msg.channels:
-                self._obj._channel_rank[channel_name] = msg.source_rank
+            stores = zip(msg.memory_budgets, msg.rings, msg.keep_lasts)
+            for channel_name, store in zip(msg.channels, stores):
+                if channel_name in self._obj._channel_ids:
+                    errors.append(f"Duplicate channel {channel_name!r}")
+                    continue
+                channel_id = len(self._obj._channel_ranks)
+                self._add_channel(channel_name, channel_id, msg.source_rank, store)
+            # shard i is hosted i ranks after the rank that declared the channel
+            for channel_name, shards, options in msg.sharded:
+                names = [shard_name(channel_name, i) for i in range(shards)]
+                if channel_name in self._obj._channel_ids or any(
+                    name in self._obj._channel_ids for name in names
+                ):
+                    errors.append(f"Duplicate channel {channel_name!r}")
+                    continue
+                self._obj._channel_shards[channel_name] = names
+                for i, name in enumerate(names):
+                    rank = (msg.source_rank + i) % SIZE
+                    if rank == RANK:
+                        self._obj._local_channels[name] = _Channel(name, *options)
+                    channel_id = len(self._obj._channel_ranks)
+                    self._add_channel(name, channel_id, rank, options[3:])
+            if msg.source_rank == RANK:
+                for i, reader_name in enumerate(self._reader_names):
+                    self._reader_ids[reader_name] = first_reader_id + i
+                for i, writer_name in enumerate(self._writer_names):
+                    self._writer_ids[writer_name] = first_writer_id + i
+            first_reader_id += msg.n_readers
+            first_writer_id += msg.n_writers
+        for channel_name, channel in self._obj._local_channels.items():
+            channel.id = self._obj._channel_ids[channel_name]
+            self._obj._channels_by_id[channel.id] = channel
+        return errors
+
+    def _add_channel(
+        self,
+        name: str,
+        channel_id: int,
+        rank: int,
+        store: tuple[int | None, _Ring_Spec | None, int | None],
+    ):
+        self._channel_stores[name] = store
+        self._obj._channel_rank[name] = rank
+        self._obj._channel_ids[name] = channel_id
+        self._obj._channel_ranks[channel_id] = rank
+
+    # the scalable counterpart of _distribute_channel_ranks. Channels are
+    # found through a directory spread over the ranks by the keys of their
+    # names, and ids are made unique without gathering anything: a channel
+    # hosted by rank r gets an id equal to r modulo SIZE, and so does a reader
+    # or writer declared on rank r. Each rank only learns of the channels it
+    # has connections to.
+    def _locate_channels(self) -> list[str]:
+        errors = []
+        declared = list(self._obj._local_channels) + list(self._sharded_channels)
+        # the ranks hosting shards are sent their names, as only the ranks
+        # declaring sharded channels know them
+        shards_by_rank: dict[int, list[tuple[str, int, int, tuple]]] = {}
+        for channel_name, (shards, options) in self._sharded_channels.items():
+            for i in range(shards):
+                shards_by_rank.setdefault((RANK + i) % SIZE, []).append(
+                    (channel_name, i, shards, options)
+                )
+        received = exchange(
+            COMM,
+            {rank: pickle.dumps(shards) for rank, shards in shards_by_rank.items()},
+        )
+        # key, shard index and number of shards of the channels hosted here
+        hosted = {name: (channel_key(name), 0, 1) for name in self._obj._local_channels}
+        for data in received.values():
+            for channel_name, i, shards, options in pickle.loads(data):
+                name = shard_name(channel_name, i)
+                if name in hosted:
+                    errors.append(f"Duplicate channel {name!r}")
+                    continue
+                self._obj._local_channels[name] = _Channel(name, *options)
+                hosted[name] = (channel_key(channel_name), i, shards)
+        # register the channels hosted here with the directory
+        registrations: dict[int, list[tuple[int, ...]]] = {}
+        for index, (name, channel) in enumerate(self._obj._local_channels.items()):
+            channel_id = RANK + SIZE * index
+            store = (channel.memory_budget, channel.ring, channel.keep_last)
+            self._add_channel(name, channel_id, RANK, store)
+            channel.id = channel_id
+            self._obj._channels_by_id[channel_id] = channel
+            key, i, shards = hosted[name]
+            budget = -1 if channel.memory_budget is None else channel.memory_budget
+            keep_last = channel.keep_last or 0
+            ring = (0,) * _Ring_Spec.WIDTH
+            if channel.ring is not None:
+                ring = channel.ring.encode()
+            registrations.setdefault(directory_rank(key, SIZE), []).append(
+                (key, i, shards, channel_id, budget, keep_last, *ring)
+            )
+        width = 6 + _Ring_Spec.WIDTH
+        directory = _Channel_Directory(width)
+        for records in exchange_records(COMM, registrations, width).values():
+            directory.register(records)
+        # look up the channels of the connections declared here, and the ones
+        # declared here to find out whether another rank declared them too
+        names = set(self._channel_reader_names) | set(self._channel_writer_names)
+        keys = {channel_key(name): name for name in names.union(declared)}
+        lookups: dict[int, list[tuple[int, ...]]] = {}
+        for key in keys:
+            lookups.setdefault(directory_rank(key, SIZE), []).append((key,))
+        replies = {
+            rank: [entry for (key,) in records for entry in directory.lookup(key)]
+            for rank, records in exchange_records(COMM, lookups, 1).items()
+        }
+        located: dict[int, list[tuple[int, ...]]] = {}
+        for records in exchange_records(COMM, replies, width).values():
+            for record in records:
+                located.setdefault(record[0], []).append(record)
+        for key, entries in located.items():
+            name = keys[key]
+            _, i, shards, *_ = entries[0]
+            if i == DUPLICATE:
+                errors.append(f"Duplicate channel {name!r}")
+                continue
+            if i == UNKNOWN:
+                # reported by _check_channel_names
+                continue
+            names = [name]
+            if shards > 1:
+                names = [shard_name(name, i) for i in range(shards)]
+                self._obj._channel_shards[name] = names
+            for _, i, _, channel_id, budget, keep_last, *ring in entries:
+                store = (
+                    None if budget < 0 else budget,
+                    _Ring_Spec.decode(ring),
+                    keep_last or None,
+                )
+                self._add_channel(names[i], channel_id, channel_id % SIZE, store)
+        for i, reader_name in enumerate(self._reader_names):
+            self._reader_ids[reader_name] = RANK + SIZE * i
+        for i, writer_name in enumerate(self._writer_names):
+            self._writer_ids[writer_name] = RANK + SIZE * i
+        return errors
+
+    # every rank raises if any rank found an error, instead of the others
+    # waiting for it in the exchanges that follow
+    def _check_channel_names(self, errors: list[str]):
+        names = set(self._channel_reader_names) | set(self._channel_writer_names)
+        for name in sorted(names):
+            known = name in self._obj._channel_ids or name in self._obj._channel_shards
+            if not known:
+                errors.append(f"Unknown channel {name!r}")
+        n_errors = COMM.allreduce(len(errors))
+        if errors:
+            raise ValueError(", ".join(errors))
+        if n_errors:
+            raise ValueError(f"Invalid channels on other ranks ({n_errors} errors)")
+
+    # sends (channel id, connection id, link tag, ...) records of `width`
+    # integers to the ranks of their channels, and returns the (source rank,
+    # records) received by this one. The tag is -1 for connections without a
+    # persistent link, readers add their subscription.
+    def _send_attachments(
+        self, attachments: dict[int, list[tuple[int, ...]]], width: int
+    ) -> Iterable[tuple[int, list[tuple[int, ...]]]]:
+        if self._scalable:
+            return exchange_records(COMM, attachments, width).items()
+        msgs = COMM.alltoall([attachments.get(rank, []) for rank in range(SIZE)])
+        logger.debug(f"({RANK}) connection msgs = {msgs}")
+        return enumerate(msgs)
+
+    # the readers and writers of a sharded channel are made of a connection
+    # per shard, named after the shard. They share the id of the connection,
+    # which only has to be unique within a channel.
+    def _shard_connections(self):
+        for channel_name, names in self._obj._channel_shards.items():
+            for reader_name in self._channel_reader_names.pop(channel_name, []):
+                shard_readers = []
+                for i, name in enumerate(names):
+                    shard_reader = shard_name(reader_name, i)
+                    self._reader_ids[shard_reader] = self._reader_ids[reader_name]
+                    self._reader_control_delay[shard_reader] = (
+                        self._reader_control_delay[reader_name]
+                    )
+                    self._reader_subscriptions[shard_reader] = (
+                        self._reader_subscriptions[reader_name]
+                    )
+                    self._channel_reader_names.setdefault(name, [])
+                    self._channel_reader_names[name].append(shard_reader)
+                    shard_readers.append(shard_reader)
+                self._sharded_reader_names[reader_name] = (channel_name, shard_readers)
+            for writer_name in self._channel_writer_names.pop(channel_name, []):
+                del self._obj._writers_by_id[writer_name]
+                shard_writers = []
+                for i, name in enumerate(names):
+                    shard_writer = shard_name(writer_name, i)
+                    self._writer_ids[shard_writer] = self._writer_ids[writer_name]
+                    writer = _Writer(
+                        shard_writer, name, None, **self._writer_options[writer_name]
+                    )
+                    self._obj._writers_by_id[shard_writer] = writer
+                    self._channel_writer_names.setdefault(name, [])
+                    self._channel_writer_names[name].append(shard_writer)
+                    shard_writers.append(writer)
+                self._obj._sharded_writers[writer_name] = _Sharded_Writer(
+                    writer_name, channel_name, shard_writers
+                )
+
+    def _set_ids(self, connection: _Reader | _Writer, ids: dict[str, int]):
+        connection.id = ids[connection.name]
+        connection.channel_id = self._obj._channel_ids[connection.channel_name]
+
+    def _attach_local_connections(self):
+        # connections declared before their channel was created on this rank
+        # are local too, they must not go through the exchanges below
+        for channel_name in list(self._channel_reader_names):
+            if channel_name in self._obj._local_channels:
+                for reader_name in self._channel_reader_names.pop(channel_name):
+                    self._create_local_reader(channel_name, reader_name)
+        for channel_name in list(self._channel_writer_names):
+            if channel_name in self._obj._local_channels:
+                for writer_name in self._channel_writer_names.pop(channel_name):
+                    self._obj._writers_by_id[writer_name].channel_rank = RANK
+        # co-located connections call into their channel directly,
+        # readers of remote channels are only created further on
+        for writer in self._obj._writers_by_id.values():
+            self._set_ids(writer, self._writer_ids)
+            writer.flusher = self._obj._flusher
+        for reader in self._obj._readers_by_id.values():
+            self._set_ids(reader, self._reader_ids)
+            channel = self._obj._local_channels[reader.channel_name]
+            channel.add_reader(reader.id, RANK, reader.subscription)
+            reader.local_channel = channel
+        for writer in self._obj._writers_by_id.values():
+            if writer.channel_name in self._obj._local_channels:
+                channel = self._obj._local_channels[writer.channel_name]
+                channel.set_writer_advancetime(writer.id, 0)
+                writer.local_channel = channel
 
     def _distribute_readers_metadata(self):
         # initialize readers that are attached to remote channels
@@ -78,65 +554,147 @@ class STMBuilder:
         #   each rank is assigned a list of reader tuples.
         #   we declare a reader by putting its metadata in the list for the rank we want to send it to
         #   after alltoall, each channels will know the rank where each reader is located
-        reader_rank_attachments: list[list[tuple[str, str]]] = [[] for _ in range(SIZE)]
+        reader_rank_attachments: dict[int, list[tuple[int, ...]]] = {}
         for channel_name, reader_names in self._channel_reader_names.items():
             channel_rank = self._obj._channel_rank[channel_name]
+            channel_id = self._obj._channel_ids[channel_name]
+            # the readers of a persistent channel on this rank share a link
+            tag = -1
+            _, ring, _ = self._channel_stores[channel_name]
+            if ring is not None and ring.persistent:
+                tag = link_tag(next(self._link_indices), READER_LINK)
+                self._obj._links.add(
+                    _Receive_Link(ring, channel_rank, tag, channel_id)
+                )
             # create reader objects
             for reader_name in reader_names:
-                reader = _Reader(reader_name, channel_name, channel_rank)
+                readers = self._obj._readers_by_channel.get(channel_id)
+                if readers is None:
+                    readers = _Local_Readers(*self._channel_stores[channel_name])
+                    self._obj._readers_by_channel[channel_id] = readers
+                reader = _Reader(
+                    reader_name,
+                    channel_name,
+                    channel_rank,
+                    readers.data,
+                    self._reader_control_delay[reader_name],
+                )
+                self._set_ids(reader, self._reader_ids)
+                reader.subscription = self._reader_subscriptions[reader_name]
+                readers.add(reader)
                 self._obj._readers_by_id[reader_name] = reader
-                self._obj._readers_by_channel.setdefault(channel_name, [])
-                self._obj._readers_by_channel[channel_name].append(reader)
                 # note the ranks that this reader has attachments to
-                reader_rank_attachments[channel_rank].append(
-                    (channel_name, reader_name)
+                subscription = reader.subscription or _Subscription()
+                reader_rank_attachments.setdefault(channel_rank, []).append(
+                    (channel_id, reader.id, tag, *subscription.encode())
                 )
         # distribute reader attachment information
-        reader_connection_msgs = COMM.alltoall(reader_rank_attachments)
-        logger.debug(f"({RANK}) reader connection msgs = {reader_connection_msgs}")
-        for source_rank, connections in enumerate(reader_connection_msgs):
-            for channel_name, reader_name in connections:
-                channel = self._obj._local_channels[channel_name]
-                channel.reader_ranks.add(source_rank)
-                channel._readers_keeptime[reader_name] = 0
+        width = 3 + _Subscription.WIDTH
+        received = self._send_attachments(reader_rank_attachments, width)
+        for source_rank, connections in received:
+            for channel_id, reader_id, tag, *subscription in connections:
+                channel = self._obj._channels_by_id[channel_id]
+                channel.add_reader(
+                    reader_id, source_rank, _Subscription.decode(subscription)
+                )
+                if tag >= 0 and source_rank not in channel.links:
+                    channel.links[source_rank] = _Send_Link(
+                        channel.ring, source_rank, tag
+                    )
+        for reader_name, (channel_name, names) in self._sharded_reader_names.items():
+            self._obj._sharded_readers[reader_name] = _Sharded_Reader(
+                reader_name,
+                channel_name,
+                [self._obj._readers_by_id[name] for name in names],
+            )
 
     def _distribute_writers_metadata(self):
         # a similar setup for writers, but for a different reason
         # each channel needs to know the advance time for each of its writers
-        writer_rank_attachments: list[list[tuple[str, str]]] = [[] for _ in range(SIZE)]
+        writer_rank_attachments: dict[int, list[tuple[int, ...]]] = {}
         for channel_name, writer_names in self._channel_writer_names.items():
             channel_rank = self._obj._channel_rank[channel_name]
+            _, ring, _ = self._channel_stores[channel_name]
             for writer_name in writer_names:
-                writer = _Writer(writer_name, channel_name, channel_rank)
-                self._obj._writers_by_id[writer_name] = writer
-                writer_rank_attachments[channel_rank].append(
-                    (channel_name, writer_name)
+                writer = self._obj._writers_by_id[writer_name]
+                writer.channel_rank = channel_rank
+                # each writer of a persistent channel has a link of its own
+                tag = -1
+                if ring is not None and ring.persistent:
+                    tag = link_tag(next(self._link_indices), WRITER_LINK)
+                    writer.link = _Send_Link(ring, channel_rank, tag)
+                writer_rank_attachments.setdefault(channel_rank, []).append(
+                    (writer.channel_id, writer.id, tag)
                 )
         # distribute writer attachment information
-        writer_connection_msgs = COMM.alltoall(writer_rank_attachments)
-        logger.debug(f"({RANK}) writer connection msgs = {writer_connection_msgs}")
-        for source_rank, connections in enumerate(writer_connection_msgs):
-            for channel_name, writer_name in connections:
-                channel = self._obj._local_channels[channel_name]
-                channel._writers_advancetime[writer_name] = 0
-
-    def build(self):
+        received = self._send_attachments(writer_rank_attachments, 3)
+        for source_rank, connections in received:
+            for channel_id, writer_id, tag in connections:
+                channel = self._obj._channels_by_id[channel_id]
+                channel._writers_advancetime[writer_id] = 0
+                if tag >= 0:
+                    self._obj._links.add(
+                        _Receive_Link(
+                            channel.ring, source_rank, tag, channel_id, writer_id
+                        )
+                    )
+
+    def _distribute_node_ranks(self):
+        # the ranks sharing memory with this one, for the "shm" transport
+        node_comm = COMM.Split_type(MPI.COMM_TYPE_SHARED)
+        node_ranks = set(node_comm.allgather(RANK))
+        # a ring per reader rank, shared by the channels of this rank
+        rings: dict[int, _Ring_Writer] = {}
+        for channel in self._obj._local_channels.values():
+            if channel.transport == "shm":
+                channel.node_reader_ranks = channel.reader_ranks & node_ranks
+                for rank in channel.node_reader_ranks:
+                    if rank not in rings:
+                        rings[rank] = _Ring_Writer(RANK, rank)
+                    channel.rings[rank] = rings[rank]
+        # every rank maps the rings written to it, they are then unlinked so
+        # that none outlives the ranks that use it
+        for rank_rings in node_comm.allgather(
+            {rank: ring.name for rank, ring in rings.items()}
+        ):
+            if RANK in rank_rings:
+                name = rank_rings[RANK]
+                self._obj._rings[name] = _Ring_Reader(name)
+        node_comm.Barrier()
+        for ring in rings.values():
+            ring.unlink()
+        node_comm.Free()
+
+    def build(self, scalable: bool = False):
         if not self._obj:
             raise Exception("Builder cannot be reused")
 
-        self._distribute_channel_ranks()
-
-        # todo: check for bad channel names in connections
+        self._scalable = scalable
+        if scalable:
+            errors = self._locate_channels()
+        else:
+            errors = self._distribute_channel_ranks()
+        self._check_channel_names(errors)
+        self._shard_connections()
+        self._attach_local_connections()
         self._distribute_readers_metadata()
         self._distribute_writers_metadata()
+        self._distribute_node_ranks()
+        if self._restore_path is not None:
+            self._restore(self._restore_path)
+        # STM messages never match the application's own, and the out-of-band
+        # buffers and persistent links never match STM messages. The
+        # persistent requests are set up on these communicators.
+        self._obj._set_comm(_STM_Comm.dup(COMM))
 
-        logger.info(
-            f"({RANK}) finished build with channel keeptimes = {
-                [(key, channel._readers_keeptime[key]) 
-                 for channel in self._obj._local_channels.values() 
-                 for key in channel._readers_keeptime]
-            }"
-        )
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                f"({RANK}) finished build with channel keeptimes = {
+                    [(key, channel._readers_keeptime[key]) 
+                     for channel in self._obj._local_channels.values() 
+                     for key in channel._readers_keeptime]
+                }"
+            )
 
         obj = self._obj
         self._obj = None
@@ -1,16 +1,21 @@
+import logging
+import threading
 from mpi4py import MPI
-from typing import Any
+from typing import Any, Literal
 
 from .log import logger
-from .connection import _Reader
-from .data import _Timed_Data
+from .connection import _Local_Readers
+from .data import _Ring_Spec, _Subscription
+from .links import _Send_Link
 from .messaging import (
     _Message_Reader_Data,
+    _Message_Reader_Data_Batch,
     _Message_Writer_Advance,
-    STM_Tag,
 )
 
 from .pqdict import _PQDict_
+from .shm import pack, _Ring_Writer
+from .transport import fan_out, _Pending_Requests
 
 
 COMM = MPI.COMM_WORLD
@@ -18,71 +23,396 @@ RANK = COMM.Get_rank()
 SIZE = COMM.Get_size()
 
 
+# the name of the i-th shard of a sharded channel, or of a connection to it
+def shard_name(name: str, i: int) -> str:
+    return f"{name}[{i}]"
+
+
 class _Channel:
-    def __init__(self, name: str):
+    def __init__(
+        self,
+        name: str,
+        fanout: int | None = None,
+        transport: Literal["mpi", "shm"] = "mpi",
+        coalesce_advances: bool = False,
+        memory_budget: int | None = None,
+        ring: _Ring_Spec | None = None,
+        keep_last: int | None = None,
+    ):
         self.name = name
-        # todo: remove self.channel_data (this is from an older iteration)
-        self.channel_data = _Timed_Data()
+        self.id: int | None = None  # assigned at build time
+        # arity of the tree used to relay data through the reader ranks,
+        # None sends to every reader rank from here
+        self.fanout = fanout
+        self.transport = transport
         self.reader_ranks: set[int] = set()
-        self.local_readers: set[_Reader] = set()
+        # with the "shm" transport, data for the reader ranks on this node is
+        # written to the shared memory ring of each rank, set at build time
+        self.node_reader_ranks: set[int] = set()
+        self.rings: dict[int, _Ring_Writer] = {}
+        # data messages sent through MPI to a rank whose ring was full
+        self._n_ring_full = 0
+        # items are only stored by the readers, once per rank, and spilled to
+        # disk past the memory_budget of the channel (in bytes), or in a ring
+        # buffer for typed channels
+        self.memory_budget = memory_budget
+        self.ring = ring
+        # latest-value channels only keep the newest keep_last items, in the
+        # stores of the readers and in the puts held back by the channel
+        self.keep_last = keep_last
+        self.local_readers = _Local_Readers(memory_budget, ring, keep_last)
+        self._held: dict[int, Any] = {}
+        self._held_put_time: float | None = None
+        self._n_collapsed = 0
+        # persistent channels send their items to each reader rank on a link
+        # of its own, set at build time
+        self.links: dict[int, _Send_Link] = {}
         self._readers_keeptime = _PQDict_()
+        # the readers of each rank, this one included, and the subscriptions
+        # of those that have one. Items are only sent to the ranks with a
+        # reader that needs them.
+        self._rank_readers: dict[int, list[int]] = {}
+        self._subscriptions: dict[int, _Subscription] = {}
         self._writers_advancetime = _PQDict_()
+        # puts received from each remote writer, and the advances that
+        # overtook some of them, as writer id -> (seq, ts)
+        self._n_puts: dict[int, int] = {}
+        self._held_advances: dict[int, tuple[int, int]] = {}
+        # data messages sent to the reader ranks, advances follow them. The
+        # ranks whose subscriptions skipped some of them expect fewer.
+        self._n_sent = 0
+        self._n_skipped: dict[int, int] = {}
+        # advance not sent to the reader ranks yet, it rides along the next data
+        # message, or is sent on its own by .flush_advance. When coalescing, the
+        # STM instance only flushes it once no message is waiting to be processed
+        self.coalesce_advances = coalesce_advances
+        self._pending_advance: tuple[int, int] | None = None
+        self._requests = _Pending_Requests()
+        # co-located writers and readers call into the channel from their own
+        # threads, next to the listener thread
+        self._lock = threading.RLock()
 
     # todo: maybe writers can do this instead?
     # todo: optimize for readers that already consumed until 'ts'
-    def publish_data(self, ts: int, item: Any):
-        self.channel_data[ts] = item
-        for reader in self.local_readers:
-            reader.data[ts] = item
-        reqs: list[MPI.Request] = []
-        msg = _Message_Reader_Data(ts, item, self.name)
-        for rank_attached in self.reader_ranks:
-            req = COMM.isend(obj=msg, dest=rank_attached, tag=STM_Tag.STM_DATA)
-            reqs.append(req)
-        logger.debug(f"({RANK}) publishing item={item} ts={ts} to {len(reqs)} ranks")
-        MPI.Request.waitall(reqs)
-        # todo: should this be waiting?
+    # `writer_id` is given for puts received from a remote writer
+    def publish_data(
+        self,
+        ts: int,
+        item: Any,
+        writer_id: int | None = None,
+        advance: int | None = None,
+        put_time: float | None = None,
+    ):
+        with self._lock:
+            self.local_readers.receive_data(ts, item)
+            if put_time is not None and self.local_readers:
+                self.local_readers.latency.add(put_time)
+            if advance is not None:
+                self._set_advancetime(writer_id, advance)
+            if self.keep_last is None:
+                self._send_item(ts, item, put_time)
+            else:
+                self._hold([(ts, item)], put_time)
+                # puts of local writers do not come in bursts of messages
+                if writer_id is None:
+                    self.flush_held()
+            if writer_id is not None:
+                self._received_put(writer_id)
+
+    # publishes a batch of items with a single message per reader rank
+    def publish_data_many(
+        self,
+        items: list[tuple[int, Any]],
+        writer_id: int | None = None,
+        advance: int | None = None,
+        put_time: float | None = None,
+    ):
+        with self._lock:
+            self.local_readers.receive_data_many(items)
+            if put_time is not None and self.local_readers:
+                self.local_readers.latency.add(put_time)
+            if advance is not None:
+                self._set_advancetime(writer_id, advance)
+            if self.keep_last is None:
+                self._send_items(items, put_time)
+            else:
+                self._hold(items, put_time)
+                if writer_id is None:
+                    self.flush_held()
+            if writer_id is not None:
+                self._received_put(writer_id)
+
+    def _send_item(self, ts: int, item: Any, put_time: float | None):
+        ranks = self._subscribed_ranks(ts)
+        # an advance only rides along data sent to every reader rank
+        advance = self._piggyback_advance() if ranks is None else None
+        msg = _Message_Reader_Data(ts, item, self.id, advance, put_time)
+        n_ranks = self._send_to_readers(msg, until=ts, ranks=ranks)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"({RANK}) publishing item={item} ts={ts} to {n_ranks} ranks")
+
+    def _send_items(self, items: list[tuple[int, Any]], put_time: float | None):
+        n_ranks = 0
+        for batch, ranks in self._subscribed_batches(items):
+            advance = None
+            if ranks is None or ranks == self.reader_ranks:
+                advance = self._piggyback_advance()
+            msg = _Message_Reader_Data_Batch(batch, self.id, advance, put_time)
+            until = max(ts for ts, _ in batch)
+            n_ranks += self._send_to_readers(msg, until=until, ranks=ranks)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"({RANK}) publishing {len(items)} items to {n_ranks} ranks")
+
+    # the puts of latest-value channels are held back until the burst of
+    # messages they came in is processed, and only the newest keep_last of
+    # them are sent to the reader ranks, by .flush_held
+    def _hold(self, items: list[tuple[int, Any]], put_time: float | None):
+        if not self.reader_ranks:
+            return
+        held = self._held
+        held.update(items)
+        if len(held) > self.keep_last:
+            for ts in sorted(held)[: -self.keep_last]:
+                del held[ts]
+                self._n_collapsed += 1
+        if put_time is not None:
+            self._held_put_time = put_time
+
+    @property
+    def has_held_items(self) -> bool:
+        return bool(self._held)
+
+    def flush_held(self):
+        with self._lock:
+            if not self._held:
+                return
+            items = sorted(self._held.items())
+            put_time = self._held_put_time
+            self._held = {}
+            self._held_put_time = None
+            if len(items) == 1:
+                ts, item = items[0]
+                self._send_item(ts, item, put_time)
+            else:
+                self._send_items(items, put_time)
+
+    def _received_put(self, writer_id: int):
+        n_puts = self._n_puts.get(writer_id, 0) + 1
+        self._n_puts[writer_id] = n_puts
+        held = self._held_advances.get(writer_id)
+        if held is not None and n_puts >= held[0]:
+            del self._held_advances[writer_id]
+            self._set_advancetime(writer_id, held[1])
+
+    def add_reader(
+        self, reader_id: int, rank: int, subscription: _Subscription | None = None
+    ):
+        self._readers_keeptime[reader_id] = 0
+        self._rank_readers.setdefault(rank, []).append(reader_id)
+        if rank != RANK:
+            self.reader_ranks.add(rank)
+        self.set_subscription(reader_id, subscription)
+
+    def set_subscription(self, reader_id: int, subscription: _Subscription | None):
+        with self._lock:
+            if subscription is None:
+                self._subscriptions.pop(reader_id, None)
+            else:
+                self._subscriptions[reader_id] = subscription
+
+    # the reader ranks that need ts, None for all of them. A rank needs it if
+    # one of its readers subscribed to ts and has not consumed it yet. Sending
+    # ts to a latest reader consumes everything before it, as the reader does
+    # once it gets ts. Relayed data goes to every rank if any of them needs it.
+    def _subscribed_ranks(self, ts: int) -> set[int] | None:
+        if not self._subscriptions:
+            return None
+        ranks = set()
+        for rank, reader_ids in self._rank_readers.items():
+            for reader_id in reader_ids:
+                if ts <= self._readers_keeptime[reader_id]:
+                    continue
+                subscription = self._subscriptions.get(reader_id)
+                if subscription is not None:
+                    if not subscription.matches(ts):
+                        continue
+                    if subscription.latest:
+                        self.set_reader_keeptime(reader_id, ts - 1)
+                ranks.add(rank)
+        ranks.discard(RANK)
+        if ranks == self.reader_ranks or (self.fanout is not None and ranks):
+            return None
+        return ranks
+
+    # the items of a batch each reader rank needs, as (items, ranks) for
+    # each set of items, the ranks being None for all of them
+    def _subscribed_batches(
+        self, items: list[tuple[int, Any]]
+    ) -> list[tuple[list[tuple[int, Any]], set[int] | None]]:
+        if not self._subscriptions:
+            return [(items, None)]
+        indices: dict[int, list[int]] = {rank: [] for rank in self.reader_ranks}
+        for i, (ts, _) in enumerate(items):
+            ranks = self._subscribed_ranks(ts)
+            for rank in self.reader_ranks if ranks is None else ranks:
+                indices[rank].append(i)
+        groups: dict[tuple[int, ...], set[int]] = {}
+        for rank, rank_indices in indices.items():
+            if rank_indices:
+                groups.setdefault(tuple(rank_indices), set()).add(rank)
+        return [
+            ([items[i] for i in group], ranks) for group, ranks in groups.items()
+        ]
+
+    # the sends are left in flight and reaped by self._requests,
+    # so a slow reader rank never stalls the listener.
+    # `until` is the last timestamp of the data in a data message, which
+    # only goes to `ranks` if given, instead of every reader rank.
+    def _send_to_readers(
+        self, msg: Any, until: int | None = None, ranks: set[int] | None = None
+    ) -> int:
+        if ranks is None:
+            ranks = self.reader_ranks
+        if not ranks:
+            return 0
+        if until is not None:
+            self._n_sent += 1
+            for rank in self.reader_ranks - ranks:
+                self._n_skipped[rank] = self._n_skipped.get(rank, 0) + 1
+        n_ranks = len(ranks)
+        if self.links and type(msg) is _Message_Reader_Data:
+            # the ranks whose link has every slot in flight get a message
+            ranks = {
+                rank
+                for rank in ranks
+                if not self.links[rank].start(msg.ts, msg.item, msg.put_time)
+            }
+        node_ranks = self.node_reader_ranks & ranks
+        if until is not None and node_ranks:
+            # only a small notification goes through MPI, the ranks whose
+            # ring is full get the message itself
+            data, raws = pack(msg)
+            for rank in sorted(node_ranks):
+                header = self.rings[rank].write(self.id, data, raws)
+                if header is None:
+                    self._n_ring_full += 1
+                    continue
+                self._requests.isend(header, rank)
+                ranks = ranks - {rank}
+        fan_out(msg, sorted(ranks), self.fanout, self._requests)
+        return n_ranks
 
     def keeptime(self) -> int:
         _, ts = self._readers_keeptime.peek()
         return ts
 
-    def set_reader_keeptime(self, reader_name: str, ts: int):
-        self._readers_keeptime[reader_name] = ts
+    def set_reader_keeptime(self, reader_id: int, ts: int):
+        self._readers_keeptime[reader_id] = ts
 
-    def handle_consume_until(self, reader_name: str, ts: int):
-        prev_chan_keeptime = self.keeptime()
-        self.set_reader_keeptime(reader_name, ts)
-        new_chan_keeptime = self.keeptime()
-        logger.info(
-            f"({RANK}) {self.name} consume until {ts}, keeptime={new_chan_keeptime}"
-        )
-        for ts in range(prev_chan_keeptime, new_chan_keeptime):
-            logger.debug(f"({RANK}) {self.name} deleting item at {ts}")
-            del self.channel_data[ts]
+    def handle_consume_until(self, reader_id: int, ts: int):
+        with self._lock:
+            # the keeptime of a latest reader can be ahead of its consumes
+            if ts <= self._readers_keeptime[reader_id]:
+                return
+            self.set_reader_keeptime(reader_id, ts)
+            keeptime = self.keeptime()
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    f"({RANK}) {self.name} consume until {ts}, keeptime={keeptime}"
+                )
 
     def advancetime(self) -> int:
         _, ts = self._writers_advancetime.peek()
         return ts
 
-    def set_writer_advancetime(self, writer_name: str, ts: int):
-        self._writers_advancetime[writer_name] = ts
+    def set_writer_advancetime(self, writer_id: int, ts: int):
+        self._writers_advancetime[writer_id] = ts
+
+    # with `defer`, the new advancetime is left pending for .flush_advance.
+    # The advance is held back until the first `seq` puts of the writer
+    # are received.
+    def handle_advance_until(
+        self, writer_id: int, ts: int, defer: bool = False, seq: int = 0
+    ):
+        with self._lock:
+            if self._n_puts.get(writer_id, 0) < seq:
+                self._held_advances[writer_id] = (seq, ts)
+                return
+            self._set_advancetime(writer_id, ts)
+            if not defer:
+                self.flush_advance()
 
-    def handle_advance_until(self, writer: str, ts: int):
+    def _set_advancetime(self, writer_id: int, ts: int):
         prev_chan_advancetime = self.advancetime()
-        self.set_writer_advancetime(writer, ts)
+        self.set_writer_advancetime(writer_id, ts)
         new_chan_advancetime = self.advancetime()
         if new_chan_advancetime <= prev_chan_advancetime:
             return
-        for reader in self.local_readers:
-            reader.channel_advancetime = ts
-        reqs: list[MPI.Request] = []
-        msg = _Message_Writer_Advance(
-            until=ts, writer_name=writer, channel_name=self.name
-        )
-        for rank_attached in self.reader_ranks:
-            req = COMM.isend(obj=msg, dest=rank_attached, tag=STM_Tag.STM_DATA)
-            reqs.append(req)
-        logger.debug(
-            f"({RANK}) publishing writer advancetime={new_chan_advancetime} to {len(reqs)} ranks"
-        )
+        self.local_readers.receive_advance(new_chan_advancetime)
+        if self.reader_ranks:
+            self._pending_advance = (writer_id, new_chan_advancetime)
+
+    def _piggyback_advance(self) -> int | None:
+        # the data of persistent channels may reach a rank out of order (see
+        # links.py), so the advance is sent on its own, with the seq of each
+        # rank
+        if self._pending_advance is None or self.links:
+            return None
+        _, ts = self._pending_advance
+        self._pending_advance = None
+        return ts
+
+    @property
+    def has_pending_advance(self) -> bool:
+        return self._pending_advance is not None
+
+    # held items are sent first, the advance follows them
+    def flush_advance(self):
+        with self._lock:
+            self.flush_held()
+            if self._pending_advance is None:
+                return
+            writer_id, ts = self._pending_advance
+            self._pending_advance = None
+            # one message per number of data messages sent to the ranks
+            ranks_by_seq: dict[int, set[int]] = {}
+            for rank in self.reader_ranks:
+                seq = self._n_sent - self._n_skipped.get(rank, 0)
+                ranks_by_seq.setdefault(seq, set()).add(rank)
+            n_ranks = 0
+            for seq, ranks in ranks_by_seq.items():
+                msg = _Message_Writer_Advance(
+                    until=ts, writer_id=writer_id, channel_id=self.id, seq=seq
+                )
+                n_ranks += self._send_to_readers(msg, ranks=ranks)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    f"({RANK}) publishing writer advancetime={ts} to {n_ranks} ranks"
+                )
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "reader_ranks": len(self.reader_ranks),
+                "keeptime": self.keeptime() if self._readers_keeptime else 0,
+                "advancetime": (
+                    self.advancetime() if self._writers_advancetime else 0
+                ),
+                "puts_received": sum(self._n_puts.values()),
+                "data_messages_sent": self._n_sent,
+                "items_collapsed": self._n_collapsed,
+                "link_sends": sum(link.n_sent for link in self.links.values()),
+                "messages_sent": self._requests.messages_sent,
+                "bytes_sent": self._requests.bytes_sent,
+                "outstanding_requests": len(self._requests),
+                "outstanding_bytes": self._requests.nbytes,
+                "shm_ring_full": self._n_ring_full,
+            }
+
+    # waits until every message sent to the reader ranks has been delivered
+    def wait_all(self):
+        with self._lock:
+            self.flush_advance()
+            self._requests.wait_all()
+            for link in self.links.values():
+                link.wait_all()
@@ -0,0 +1,109 @@
+import mmap
+import os
+import pickle
+import struct
+from collections.abc import Iterator
+from typing import Any, BinaryIO
+
+
+# a checkpoint is one file per rank, written front to back: the magic, then
+# records of (kind, ts, pickle size, number of buffers), the buffer sizes,
+# the pickle (protocol 5) and its out-of-band buffers (e.g. numpy arrays).
+# Buffers are written raw and aligned, so that restored arrays are views of
+# the mapped file instead of copies.
+MAGIC = b"STMCKPT\x01"
+ALIGNMENT = 64
+
+_RECORD = struct.Struct("<BqQI")
+
+
+# kinds of records
+class Checkpoint_Record:
+    END = 0
+    HEADER = 1  # rank, ranks and channel names in id order
+    CHANNEL = 2  # keeptimes and advancetimes of a channel hosted by the rank
+    READERS = 3  # a reader store, followed by the ITEM records in it
+    ITEM = 4
+    WRITERS = 5
+
+
+def checkpoint_file(path: str, rank: int) -> str:
+    return os.path.join(path, f"rank-{rank}.stm")
+
+
+class _Checkpoint_Writer:
+    def __init__(self, f: BinaryIO):
+        self._f = f
+        self._position = 0
+        self._write(MAGIC)
+
+    def _write(self, data: bytes | memoryview):
+        self._f.write(data)
+        self._position += len(data) if isinstance(data, bytes) else data.nbytes
+
+    def _align(self):
+        padding = -self._position % ALIGNMENT
+        if padding:
+            self._write(bytes(padding))
+
+    def write(self, kind: int, obj: Any = None, ts: int = 0):
+        buffers: list[pickle.PickleBuffer] = []
+        data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        raws = [buf.raw() for buf in buffers]
+        self._write(_RECORD.pack(kind, ts, len(data), len(raws)))
+        self._write(struct.pack(f"<{len(raws)}Q", *(raw.nbytes for raw in raws)))
+        self._write(data)
+        for raw in raws:
+            self._align()
+            self._write(raw)
+
+
+# writes the file of a rank next to its final path and moves it there once
+# complete, so that an interrupted checkpoint never replaces the previous one
+def write_checkpoint(path: str, rank: int, records: Iterator[tuple]):
+    os.makedirs(path, exist_ok=True)
+    final = checkpoint_file(path, rank)
+    partial = f"{final}.partial"
+    with open(partial, "wb") as f:
+        writer = _Checkpoint_Writer(f)
+        for record in records:
+            writer.write(*record)
+        writer.write(Checkpoint_Record.END)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, final)
+
+
+# yields the (kind, ts, obj) records of the file of a rank. The file is
+# mapped read-only, out-of-band buffers are read-only views of the map, which
+# is released once nothing refers to them anymore.
+def read_checkpoint(path: str, rank: int) -> Iterator[tuple[int, int, Any]]:
+    file = checkpoint_file(path, rank)
+    with open(file, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < len(MAGIC):
+            raise ValueError(f"{file} is not an STM checkpoint")
+        mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    if view[: len(MAGIC)] != MAGIC:
+        raise ValueError(f"{file} is not an STM checkpoint")
+    position = len(MAGIC)
+    while True:
+        if position + _RECORD.size > size:
+            raise ValueError(f"{file} is truncated")
+        kind, ts, data_size, n_buffers = _RECORD.unpack_from(view, position)
+        position += _RECORD.size
+        buffer_sizes = struct.unpack_from(f"<{n_buffers}Q", view, position)
+        position += 8 * n_buffers
+        data = view[position : position + data_size]
+        position += data_size
+        buffers = []
+        for buffer_size in buffer_sizes:
+            position += -position % ALIGNMENT
+            buffers.append(view[position : position + buffer_size])
+            position += buffer_size
+        if position > size:
+            raise ValueError(f"{file} is truncated")
+        if kind == Checkpoint_Record.END:
+            return
+        yield kind, ts, pickle.loads(data, buffers=buffers)
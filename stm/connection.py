@@ -1,63 +1,873 @@
+import asyncio
+from collections.abc import AsyncIterator, Callable
+import heapq
+from operator import itemgetter
+import threading
+import time
 from mpi4py import MPI
 from typing import Any
 
 from .messaging import (
     _Message_Reader_Consume,
+    _Message_Reader_Subscribe,
     _Message_Channel_Put,
+    _Message_Channel_Put_Batch,
     _Message_Writer_Advance,
-    STM_Tag,
 )
-from .data import _Timed_Data
+from .flusher import _Flusher
+from .data import (
+    _Latest_Timed_Data,
+    _Ring_Spec,
+    _Ring_Timed_Data,
+    _Shared_Timed_Data,
+    _Subscription,
+)
+from .pqdict import _PQDict_
+from .stats import _Latency_Stats
+from .transport import _Pending_Requests
 
 
 COMM = MPI.COMM_WORLD
+RANK = COMM.Get_rank()
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+# futures are resolved on the thread of their event loop, whichever thread
+# processes the message that resolves them
+def _resolve_threadsafe(future: asyncio.Future):
+    try:
+        future.get_loop().call_soon_threadsafe(_resolve, future)
+    except RuntimeError:
+        # the loop was closed, nothing is awaiting the future anymore
+        pass
 
 
 class _Reader:
-    def __init__(self, name: str, channel_name: str, channel_rank: int):
+    def __init__(
+        self,
+        name: str,
+        channel_name: str,
+        channel_rank: int,
+        data: _Shared_Timed_Data | None = None,
+        control_delay: float | None = None,
+    ):
         self.name = name
-        self.data = _Timed_Data()
+        # the item store is shared with the other readers of the channel on
+        # this rank, only items <= self.keeptime are filtered out
+        self.data = _Shared_Timed_Data() if data is None else data
+        self.data.add_reader(name)
         self.keeptime = 0
         self.channel_name = channel_name
         self.channel_rank = channel_rank
+        # assigned at build time
+        self.id: int | None = None
+        self.channel_id: int | None = None
         self.channel_advancetime = 0
+        # set at build time when the channel lives on this rank,
+        # consumes are then handed to it directly instead of through MPI
+        self.local_channel = None
+        # with a control_delay, consumes are sent at most once per control_delay
+        # seconds, and only the latest one is sent
+        self.control_delay = control_delay
+        self._pending_consume: int | None = None
+        self._consume_sent_at = 0.0
+        self._requests = _Pending_Requests()
+        # the timestamps the channel sends for this reader, None for all of them
+        self.subscription: _Subscription | None = None
+        # guards data/keeptime/channel_advancetime between the listener and getters,
+        # this is the lock of the shared store
+        self._lock = self.data.lock
+        # threads blocked in .get are parked on one condition per timestamp,
+        # so resolving a timestamp only wakes the threads waiting on it
+        self._waiters: dict[int, list] = {}  # ts -> [condition, n_waiting]
+        # coroutines awaiting .get_async are parked on futures instead
+        self._futures: dict[int, list[asyncio.Future]] = {}
+        self._waiting_ts = _PQDict_()
+        # futures of .stream, as (ts, future), resolved once the channel's
+        # advancetime passes ts
+        self._advance_futures: list[tuple[int, asyncio.Future]] = []
+
+    def _resolved(self, ts: int) -> bool:
+        return ts <= self.keeptime or ts in self.data or ts < self.channel_advancetime
+
+    def get(self, ts: int, wait: bool = False, timeout: float | None = None):
+        with self._lock:
+            if wait and not self._resolved(ts):
+                self._wait(ts, timeout)
+            return self._get(ts)
 
-    def get(self, ts: int):
+    def _get(self, ts: int) -> tuple[Any, bool]:
+        # must be called with self._lock held
         if ts <= self.keeptime:
             return None, False
         item = self.data[ts]
         if ts < self.channel_advancetime:
             return item, False
         return item, True
-        # if not item and not wait:
-        # return item
-        # todo: block until item becomes available OR channel_advancetime reaches ts
-        # return item
+
+    # like .get with wait=True, but awaits instead of blocking the thread.
+    # A resolved future only means ts may be resolved, as an item stored at
+    # ts can be dropped again before this runs, it is then awaited again.
+    async def get_async(
+        self, ts: int, timeout: float | None = None
+    ) -> tuple[Any, bool]:
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            with self._lock:
+                if self._resolved(ts):
+                    return self._get(ts)
+                future = loop.create_future()
+                futures = self._futures.get(ts)
+                if futures is None:
+                    futures = self._futures[ts] = []
+                    self._waiting_ts[ts] = ts
+                futures.append(future)
+            remaining = None if deadline is None else deadline - loop.time()
+            try:
+                await asyncio.wait_for(future, remaining)
+            except TimeoutError:
+                return self.get(ts)
+            finally:
+                with self._lock:
+                    self._discard_future(ts, future)
+
+    def _discard_future(self, ts: int, future: asyncio.Future):
+        # must be called with self._lock held
+        futures = self._futures.get(ts)
+        if futures is None or future not in futures:
+            return
+        futures.remove(future)
+        if not futures:
+            del self._futures[ts]
+            if ts not in self._waiters and ts in self._waiting_ts:
+                del self._waiting_ts[ts]
+
+    # yields the (ts, item) pairs with from_ts <= ts < until in timestamp
+    # order, each one once the channel's advancetime passes it, so no earlier
+    # item can still arrive. Items consumed by this reader are skipped.
+    async def stream(
+        self, from_ts: int = 0, until: int | None = None
+    ) -> AsyncIterator[tuple[int, Any]]:
+        last = from_ts - 1  # items up to last have been yielded
+        while until is None or last < until - 1:
+            final = self.channel_advancetime - 1
+            if until is not None:
+                final = min(final, until - 1)
+            if final > last:
+                for entry in self._items(last, final):
+                    yield entry
+                last = final
+            else:
+                await self._advance_future(last + 1)
+
+    # items with lo < ts <= hi that this reader has not consumed
+    def _items(self, lo: int, hi: int) -> list[tuple[int, Any]]:
+        with self._lock:
+            return list(self.data.items(max(lo, self.keeptime), hi))
+
+    # a future resolved once the channel's advancetime passes ts
+    def _advance_future(self, ts: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        with self._lock:
+            if self.channel_advancetime > ts:
+                future.set_result(None)
+            else:
+                self._advance_futures.append((ts, future))
+        return future
+
+    # the waiters on ts stay registered until ts is resolved or they time
+    # out, and then unregister themselves: an item stored at ts may be dropped
+    # again (evicted by a newer one) before a woken waiter runs, which then
+    # waits for the advance past ts
+    def _wait(self, ts: int, timeout: float | None):
+        # must be called with self._lock held
+        waiter = self._waiters.get(ts)
+        if waiter is None:
+            waiter = [threading.Condition(self._lock), 0]
+            self._waiters[ts] = waiter
+            self._waiting_ts[ts] = ts
+        waiter[1] += 1
+        try:
+            waiter[0].wait_for(lambda: self._resolved(ts), timeout)
+        finally:
+            waiter[1] -= 1
+            if waiter[1] == 0:
+                del self._waiters[ts]
+                if ts not in self._futures and ts in self._waiting_ts:
+                    del self._waiting_ts[ts]
+
+    # notifies the waiters on ts, which check whether it is resolved
+    def _wake(self, ts: int):
+        waiter = self._waiters.get(ts)
+        futures = self._futures.pop(ts, None)
+        if waiter is None and futures is None:
+            return
+        if waiter is not None:
+            waiter[0].notify_all()
+        elif ts in self._waiting_ts:
+            del self._waiting_ts[ts]
+        if futures is not None:
+            for future in futures:
+                _resolve_threadsafe(future)
+
+    def _wake_until(self, ts: int):
+        # wakes every waiter with a timestamp < ts, which is resolved for
+        # them, so they are only notified once
+        while self._waiting_ts:
+            _, waiting_ts = self._waiting_ts.peek()
+            if waiting_ts >= ts:
+                break
+            del self._waiting_ts[waiting_ts]
+            self._wake(waiting_ts)
+
+    def _receive_advance(self, ts: int):
+        # must be called with self._lock held
+        if ts <= self.channel_advancetime:
+            return
+        self.channel_advancetime = ts
+        self._wake_until(ts)
+        if self._advance_futures:
+            waiting = []
+            for wait_ts, future in self._advance_futures:
+                if wait_ts < ts:
+                    _resolve_threadsafe(future)
+                elif not future.done():
+                    waiting.append((wait_ts, future))
+            self._advance_futures = waiting
+
+    def get_all(self, until: int) -> list[tuple[int, Any]]:
+        with self._lock:
+            return list(self.data.items(self.keeptime, until))
+
+    # the items of a typed channel with lo <= ts < hi as one array, a view of
+    # the ring unless the range wraps around its end, and a boolean array of
+    # the timestamps that hold an item not consumed by this reader. The view
+    # is only valid until those items are consumed.
+    def get_range(self, lo: int, hi: int) -> tuple[Any, Any]:
+        if not isinstance(self.data, _Ring_Timed_Data):
+            raise TypeError(f"{self.channel_name} is not a typed channel")
+        with self._lock:
+            return self.data.range(lo, hi, self.keeptime)
+
+    def get_first(self) -> tuple[Any, int | None]:
+        with self._lock:
+            entry = self.data.first_after(self.keeptime)
+        if entry is None:
+            return None, None
+        ts, item = entry
+        return item, ts
+
+    def get_last(self) -> tuple[Any, int | None]:
+        with self._lock:
+            entry = self.data.last()
+            if entry is None or entry[0] <= self.keeptime:
+                return None, None
+        ts, item = entry
+        return item, ts
+
+    # the newest item at or before ts that this reader has not consumed, as
+    # (item, its timestamp)
+    def get_at_or_before(self, ts: int) -> tuple[Any, int | None]:
+        with self._lock:
+            entry = self.data.last_at_or_before(ts)
+            if entry is None or entry[0] <= self.keeptime:
+                return None, None
+        ts, item = entry
+        return item, ts
 
     def consume_until(self, time: int):
-        if time > self.keeptime:
-            for ts in range(self.keeptime, time + 1):
-                del self.data[ts]
-            self.keeptime = time
-            msg = _Message_Reader_Consume(time, self.name, self.channel_name)
-            COMM.isend(obj=msg, dest=self.channel_rank, tag=STM_Tag.STM_DATA)
+        with self._lock:
+            if time <= self.keeptime:
+                return
+            self._consume(time)
+        if self.local_channel is not None:
+            self.local_channel.handle_consume_until(self.id, time)
+            return
+        self._pending_consume = time
+        if self._control_due():
+            self.flush()
+
+    def _consume(self, time: int):
+        # must be called with self._lock held
+        self.keeptime = time
+        self.data.consume(self.name, time)
+        self._wake_until(time + 1)
+
+    # whether the channel sends ts for this reader
+    def _wants(self, ts: int) -> bool:
+        if ts <= self.keeptime:
+            return False
+        return self.subscription is None or self.subscription.matches(ts)
+
+    # replaces the subscription of the reader. Items the channel publishes
+    # once it gets the new subscription follow it, items it already skipped
+    # are not sent again.
+    def subscribe(
+        self,
+        stride: int | None = None,
+        window: tuple[int, int] | None = None,
+        latest: bool = False,
+    ):
+        subscription = _Subscription.of(stride, window, latest)
+        with self._lock:
+            self.subscription = subscription
+        if self.local_channel is not None:
+            self.local_channel.set_subscription(self.id, subscription)
+            return
+        msg = _Message_Reader_Subscribe(subscription, self.id, self.channel_id)
+        self._requests.isend(msg, self.channel_rank)
+
+    def _control_due(self) -> bool:
+        if self.control_delay is None:
+            return True
+        return time.monotonic() - self._consume_sent_at >= self.control_delay
+
+    # sends the consume held back by the control_delay, if any
+    def flush(self):
+        if self._pending_consume is None:
+            return
+        msg = _Message_Reader_Consume(self._pending_consume, self.id, self.channel_id)
+        self._requests.isend(msg, self.channel_rank)
+        self._pending_consume = None
+        self._consume_sent_at = time.monotonic()
+
+    # waits until every consume message sent by this reader has been delivered
+    def wait_all(self):
+        self.flush()
+        self._requests.wait_all()
+
+
+class _Local_Readers:
+    """
+    The readers of one channel on this rank. Items received for the channel
+    are stored once, in the store shared by all of them.
+
+    """
+
+    def __init__(
+        self,
+        memory_budget: int | None = None,
+        ring: _Ring_Spec | None = None,
+        keep_last: int | None = None,
+    ):
+        if ring is not None:
+            self.data = _Ring_Timed_Data(ring)
+        elif keep_last is not None:
+            self.data = _Latest_Timed_Data(keep_last, memory_budget)
+        else:
+            self.data = _Shared_Timed_Data(memory_budget)
+        self._readers: list[_Reader] = []
+        # data messages received from the channel, an advance that overtook
+        # some of them is held back as (seq, ts) until they are received
+        self._n_received = 0
+        self._held_advance: tuple[int, int] | None = None
+        self.latency = _Latency_Stats()
+
+    def __iter__(self):
+        return iter(self._readers)
+
+    def __len__(self):
+        return len(self._readers)
+
+    def add(self, reader: _Reader):
+        self._readers.append(reader)
+
+    def receive_data(self, ts: int, item: Any):
+        with self.data.lock:
+            # nothing to keep once every reader has consumed ts,
+            # or when the channel has no reader on this rank
+            if self._readers and ts > self.data.keeptime():
+                self._store(ts, item)
+            self._wake(ts)
+            self._received(1)
+
+    # `n_msgs` is the number of data messages the items were received in
+    def receive_data_many(self, items: list[tuple[int, Any]], n_msgs: int = 1):
+        with self.data.lock:
+            if self._readers:
+                keeptime = self.data.keeptime()
+                for ts, item in items:
+                    if ts > keeptime:
+                        self._store(ts, item)
+                    self._wake(ts)
+            self._received(n_msgs)
+
+    # with subscriptions, items are only stored if a reader wants them, as
+    # the channel may send them for the other readers of the rank. A latest
+    # reader consumes everything before the items it wants, which the channel
+    # does on its side as well.
+    def _store(self, ts: int, item: Any):
+        readers = self._readers
+        if all(reader.subscription is None for reader in readers):
+            self.data[ts] = item
+            return
+        wanting = [reader for reader in readers if reader._wants(ts)]
+        if wanting:
+            self.data[ts] = item
+        for reader in wanting:
+            if reader.subscription is not None and reader.subscription.latest:
+                reader._consume(ts - 1)
+
+    # waiters on ts are only woken if it is resolved for their reader. An
+    # item dropped because no reader on the rank subscribed to it, or by the
+    # store (older than the items of a keep_last store, or not fitting a
+    # ring), leaves them registered, to be woken by the advance past it.
+    def _wake(self, ts: int):
+        for reader in self._readers:
+            if reader._resolved(ts):
+                reader._wake(ts)
+
+    def _received(self, n_msgs: int):
+        self._n_received += n_msgs
+        held = self._held_advance
+        if held is not None and self._n_received >= held[0]:
+            _, ts = held
+            self._held_advance = None
+            self._advance(ts)
+
+    # the advance is applied once the first `seq` data messages are received
+    def receive_advance(self, ts: int, seq: int = 0):
+        with self.data.lock:
+            if self._n_received < seq:
+                self._held_advance = (seq, ts)
+                return
+            self._advance(ts)
+
+    def _advance(self, ts: int):
+        for reader in self._readers:
+            reader._receive_advance(ts)
+
+    def stats(self) -> dict[str, Any]:
+        with self.data.lock:
+            stats = {
+                "readers": len(self._readers),
+                "items_retained": len(self.data),
+                "data_messages_received": self._n_received,
+                "advancetime": max(
+                    (reader.channel_advancetime for reader in self._readers),
+                    default=0,
+                ),
+                "put_latency": self.latency.as_dict(),
+            }
+            if self.data.memory_budget is not None:
+                stats["bytes_in_memory"] = self.data.resident_bytes
+                stats["items_spilled"] = self.data.n_spilled
+            if isinstance(self.data, (_Ring_Timed_Data, _Latest_Timed_Data)):
+                stats["items_overwritten"] = self.data.n_overwritten
+            return stats
 
 
 class _Writer:
-    def __init__(self, name: str, channel_name: str, channel_rank: int):
+    def __init__(
+        self,
+        name: str,
+        channel_name: str,
+        channel_rank: int | None,
+        batch_size: int | None = None,
+        batch_delay: float | None = None,
+        max_pending: int | None = None,
+        max_pending_bytes: int | None = None,
+        block_when_full: bool = True,
+        control_delay: float | None = None,
+    ):
         self.name = name
         self.channel_name = channel_name
         self.channel_rank = channel_rank
+        # assigned at build time
+        self.id: int | None = None
+        self.channel_id: int | None = None
         self.advancetime = 0
+        # set at build time when the channel lives on this rank, puts and
+        # advances are then handed to it directly instead of through MPI
+        self.local_channel = None
+        # coalescing buffer, puts are held back until batch_size items are
+        # buffered or the oldest one has been buffered for batch_delay seconds
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._buffer: list[tuple[int, Any]] = []
+        self._buffer_since = 0.0
+        # with a batch_delay, the flusher sends a buffer that no later put
+        # fills up, once its delay is over
+        self._buffer_flush: list | None = None
+        # with a control_delay, advances are sent on their own at most once per
+        # control_delay seconds, and only the latest one is sent. A pending
+        # advance rides along with the next put sent to the channel.
+        self.control_delay = control_delay
+        self._pending_advance: int | None = None
+        self._advance_sent_at = 0.0
+        # an advance still held back once the delay is over is sent by the
+        # flusher of the STM instance, set at build time, from its thread.
+        # Sends are serialized by the lock.
+        self.flusher: _Flusher | None = None
+        self._advance_flush: list | None = None
+        self._lock = threading.RLock()
+        # put messages sent to the channel, advances are applied after them
+        self._n_puts = 0
+        # the persistent link of writers of remote persistent channels, set at
+        # build time. A put is sent as a message when the link is full.
+        self.link = None
+        # in-flight sends, capping them keeps a fast writer from flooding the channel
+        self._requests = _Pending_Requests(
+            max_pending, max_pending_bytes, block=block_when_full
+        )
+
+    def _buffering(self) -> bool:
+        return self.batch_size is not None or self.batch_delay is not None
+
+    def _buffer_full(self) -> bool:
+        if self.batch_size is not None and len(self._buffer) >= self.batch_size:
+            return True
+        if self.batch_delay is not None:
+            return time.monotonic() - self._buffer_since >= self.batch_delay
+        return False
 
     def put(self, ts: int, item: Any):
         # todo: optimize using advancetime
-        msg = _Message_Channel_Put(ts, item, self.channel_rank, self.channel_name)
-        COMM.isend(obj=msg, dest=self.channel_rank, tag=STM_Tag.STM_DATA)
-        # todo: manage pending requests, look into this
+        if self._buffering():
+            self.put_many([(ts, item)])
+            return
+        if self.local_channel is not None:
+            self.local_channel.publish_data(ts, item)
+            return
+        with self._lock:
+            self._put(ts, item)
+
+    def _put(self, ts: int, item: Any):
+        # must be called with self._lock held
+        put_time = time.time()
+        link = self.link
+        if link is not None:
+            # the advance follows as a control message, see links.py
+            if not link.start(ts, item, put_time):
+                msg = _Message_Channel_Put(
+                    ts, item, RANK, self.channel_id, self.id, None, put_time
+                )
+                self._requests.isend(msg, self.channel_rank)
+            self._n_puts += 1
+            self._flush_advance()
+            return
+        msg = _Message_Channel_Put(
+            ts,
+            item,
+            RANK,
+            self.channel_id,
+            self.id,
+            self._pending_advance,
+            put_time,
+        )
+        self._requests.isend(msg, self.channel_rank)
+        self._n_puts += 1
+        self._pending_advance = None
+
+    # like .put, but a send refused because too many are in flight is retried
+    # from the event loop instead of blocking it, whatever block_when_full is
+    async def put_async(self, ts: int, item: Any):
+        if self._try_send(self.put, ts, item):
+            return
+        # a buffered item is kept in the buffer, only the flush is retried
+        retry = (self.flush,) if self._buffering() else (self.put, ts, item)
+        backoff = 1e-5
+        while True:
+            await asyncio.sleep(backoff)
+            if self._try_send(*retry):
+                return
+            backoff = min(backoff * 2, 1e-3)
+
+    def _try_send(self, send: Callable, *args) -> bool:
+        requests = self._requests
+        with self._lock:
+            block, requests.block = requests.block, False
+            try:
+                send(*args)
+            except BlockingIOError:
+                return False
+            finally:
+                requests.block = block
+        return True
+
+    def put_many(self, items: list[tuple[int, Any]]):
+        with self._lock:
+            if not self._buffer:
+                self._buffer_since = time.monotonic()
+                if self.batch_delay is not None:
+                    self._schedule_buffer(self.batch_delay)
+            self._buffer.extend(items)
+            if not self._buffering() or self._buffer_full():
+                self._flush()
+
+    def _schedule_buffer(self, delay: float):
+        # must be called with self._lock held
+        if self._buffer_flush is not None or self.flusher is None:
+            return
+        self._buffer_flush = self.flusher.schedule(delay, self._send_buffer)
+
+    def _send_buffer(self):
+        with self._lock:
+            self._buffer_flush = None
+            if not self._buffer:
+                return
+            try:
+                self._flush()
+            except BlockingIOError:
+                self._schedule_buffer(self.batch_delay)
+
+    def _cancel_buffer_flush(self):
+        # must be called with self._lock held
+        if self._buffer_flush is not None:
+            self.flusher.cancel(self._buffer_flush)
+            self._buffer_flush = None
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        # must be called with self._lock held
+        if not self._buffer:
+            self._flush_advance()
+            return
+        if self.local_channel is not None:
+            self.local_channel.publish_data_many(self._buffer)
+            self._buffer = []
+            self._cancel_buffer_flush()
+            return
+        # batches of writers with a link may overtake its records, the
+        # advance follows them as a control message
+        advance = self._pending_advance if self.link is None else None
+        msg = _Message_Channel_Put_Batch(
+            self._buffer,
+            RANK,
+            self.channel_id,
+            self.id,
+            advance,
+            time.time(),
+        )
+        # the buffer is kept if the send is refused for backpressure
+        self._requests.isend(msg, self.channel_rank)
+        self._n_puts += 1
+        self._buffer = []
+        self._cancel_buffer_flush()
+        if self.link is not None:
+            self._flush_advance()
+        self._pending_advance = None
+
+    def _flush_advance(self):
+        # must be called with self._lock held
+        if self._pending_advance is None:
+            return
+        msg = _Message_Writer_Advance(
+            self._pending_advance, self.id, self.channel_id, self._n_puts
+        )
+        self._requests.isend(msg, self.channel_rank)
+        self._pending_advance = None
+        self._advance_sent_at = time.monotonic()
 
     def advance_until(self, ts: int):
-        if ts > self.advancetime:
+        if ts <= self.advancetime:
+            return
+        if self.local_channel is not None:
+            self.flush()
+            self.local_channel.handle_advance_until(self.id, ts)
             self.advancetime = ts
-            msg = _Message_Writer_Advance(ts, self.name, self.channel_name)
-            COMM.isend(obj=msg, dest=self.channel_rank, tag=STM_Tag.STM_DATA)
+            return
+        with self._lock:
+            self._pending_advance = ts
+            self.advancetime = ts
+            if self._buffer:
+                # buffered puts must reach the channel before the advance does,
+                # the advance is sent along with them
+                self._flush()
+            elif self.control_delay is None:
+                self._flush_advance()
+            else:
+                wait = self.control_delay - (time.monotonic() - self._advance_sent_at)
+                if wait <= 0:
+                    self._flush_advance()
+                else:
+                    self._schedule_advance(wait)
+
+    # a held back advance must be sent even if no put or advance follows it,
+    # a reader of another rank may be waiting for it
+    def _schedule_advance(self, delay: float):
+        # must be called with self._lock held
+        if self._advance_flush is not None or self.flusher is None:
+            return
+        self._advance_flush = self.flusher.schedule(delay, self._send_held_advance)
+
+    def _send_held_advance(self):
+        with self._lock:
+            self._advance_flush = None
+            try:
+                self._flush_advance()
+            except BlockingIOError:
+                # put_async refuses to block, the advance is retried later
+                self._schedule_advance(self.control_delay)
+
+    # waits until every message sent by this writer has been delivered
+    def wait_all(self):
+        with self._lock:
+            if self._advance_flush is not None:
+                self.flusher.cancel(self._advance_flush)
+                self._advance_flush = None
+            self._flush()
+        self._requests.wait_all()
+        if self.link is not None:
+            self.link.wait_all()
+
+
+class _Sharded_Reader:
+    """
+    A reader of a channel sharded by timestamp, made of one reader per shard.
+    Each timestamp is read from its shard, and the keeptime and advancetime
+    of the channel are the lowest ones of the shards.
+
+    """
+
+    def __init__(self, name: str, channel_name: str, shards: list[_Reader]):
+        self.name = name
+        self.channel_name = channel_name
+        self._shards = shards
+
+    def _shard(self, ts: int) -> _Reader:
+        return self._shards[ts % len(self._shards)]
+
+    @property
+    def keeptime(self) -> int:
+        return min(shard.keeptime for shard in self._shards)
+
+    @property
+    def channel_advancetime(self) -> int:
+        return min(shard.channel_advancetime for shard in self._shards)
+
+    def get(self, ts: int, wait: bool = False, timeout: float | None = None):
+        return self._shard(ts).get(ts, wait, timeout)
+
+    async def get_async(
+        self, ts: int, timeout: float | None = None
+    ) -> tuple[Any, bool]:
+        return await self._shard(ts).get_async(ts, timeout)
+
+    # items are yielded in timestamp order, once every shard advanced past them
+    async def stream(
+        self, from_ts: int = 0, until: int | None = None
+    ) -> AsyncIterator[tuple[int, Any]]:
+        last = from_ts - 1
+        while until is None or last < until - 1:
+            # the shard that is the furthest behind holds back the others
+            slowest = min(self._shards, key=lambda shard: shard.channel_advancetime)
+            final = slowest.channel_advancetime - 1
+            if until is not None:
+                final = min(final, until - 1)
+            if final > last:
+                shard_items = [shard._items(last, final) for shard in self._shards]
+                for entry in heapq.merge(*shard_items, key=itemgetter(0)):
+                    yield entry
+                last = final
+            else:
+                await slowest._advance_future(last + 1)
+
+    def get_all(self, until: int) -> list[tuple[int, Any]]:
+        shard_items = [shard.get_all(until) for shard in self._shards]
+        return list(heapq.merge(*shard_items, key=itemgetter(0)))
+
+    # the rows of each timestamp are taken from its shard, into a new array
+    def get_range(self, lo: int, hi: int) -> tuple[Any, Any]:
+        values, received = (a.copy() for a in self._shards[0].get_range(lo, hi))
+        for shard in self._shards[1:]:
+            shard_values, shard_received = shard.get_range(lo, hi)
+            values[shard_received] = shard_values[shard_received]
+            received |= shard_received
+        return values, received
+
+    def get_first(self) -> tuple[Any, int | None]:
+        entries = [shard.get_first() for shard in self._shards]
+        entries = [entry for entry in entries if entry[1] is not None]
+        if not entries:
+            return None, None
+        return min(entries, key=itemgetter(1))
+
+    def get_last(self) -> tuple[Any, int | None]:
+        entries = [shard.get_last() for shard in self._shards]
+        entries = [entry for entry in entries if entry[1] is not None]
+        if not entries:
+            return None, None
+        return max(entries, key=itemgetter(1))
+
+    def get_at_or_before(self, ts: int) -> tuple[Any, int | None]:
+        entries = [shard.get_at_or_before(ts) for shard in self._shards]
+        entries = [entry for entry in entries if entry[1] is not None]
+        if not entries:
+            return None, None
+        return max(entries, key=itemgetter(1))
+
+    def consume_until(self, time: int):
+        for shard in self._shards:
+            shard.consume_until(time)
+
+    def subscribe(
+        self,
+        stride: int | None = None,
+        window: tuple[int, int] | None = None,
+        latest: bool = False,
+    ):
+        for shard in self._shards:
+            shard.subscribe(stride, window, latest)
+
+    def flush(self):
+        for shard in self._shards:
+            shard.flush()
+
+    def wait_all(self):
+        for shard in self._shards:
+            shard.wait_all()
+
+
+class _Sharded_Writer:
+    """
+    A writer of a channel sharded by timestamp, made of one writer per shard.
+    Puts go to the shard of their timestamp, advances go to every shard.
+
+    """
+
+    def __init__(self, name: str, channel_name: str, shards: list[_Writer]):
+        self.name = name
+        self.channel_name = channel_name
+        self._shards = shards
+
+    def _shard(self, ts: int) -> _Writer:
+        return self._shards[ts % len(self._shards)]
+
+    @property
+    def advancetime(self) -> int:
+        return min(shard.advancetime for shard in self._shards)
+
+    def put(self, ts: int, item: Any):
+        self._shard(ts).put(ts, item)
+
+    async def put_async(self, ts: int, item: Any):
+        await self._shard(ts).put_async(ts, item)
+
+    def put_many(self, items: list[tuple[int, Any]]):
+        shard_items: list[list[tuple[int, Any]]] = [[] for _ in self._shards]
+        for ts, item in items:
+            shard_items[ts % len(self._shards)].append((ts, item))
+        for shard, items in zip(self._shards, shard_items):
+            if items:
+                shard.put_many(items)
+
+    def flush(self):
+        for shard in self._shards:
+            shard.flush()
+
+    def advance_until(self, ts: int):
+        for shard in self._shards:
+            shard.advance_until(ts)
+
+    def wait_all(self):
+        for shard in self._shards:
+            shard.wait_all()
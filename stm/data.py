@@ -1,16 +1,435 @@
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass
+import heapq
+import threading
 from typing import Any
 
+from .log import logger
+from .pqdict import _PQDict_
+from .spill import item_size, _Spill, _Spilled
 
-# todo: support floating point numbers as keys
+
+# keys are kept in a sorted list next to the dict so that range queries and
+# truncation cost O(log n + k) in the number of stored items, rather than
+# O(width) in the timestamp range they cover (sparse timestamps are common)
 class _Timed_Data:
     def __init__(self):
         self._data = {}
+        self._keys = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, ts: int):
+        return ts in self._data
 
     def __getitem__(self, ts: int):
         return self._data.get(ts, None)
 
+    # the item stored at ts, which must be there
+    def _value(self, ts: int) -> Any:
+        return self._data[ts]
+
     def __setitem__(self, ts: int, item: Any):
+        if ts not in self._data:
+            keys = self._keys
+            # in-order puts are the common case, keep those O(1)
+            if not keys or ts > keys[-1]:
+                keys.append(ts)
+            else:
+                insort(keys, ts)
         self._data[ts] = item
 
     def __delitem__(self, ts: int):
-        self._data.pop(ts, None)
+        if ts not in self._data:
+            return
+        del self._data[ts]
+        del self._keys[bisect_left(self._keys, ts)]
+
+    def first(self) -> tuple[int, Any] | None:
+        if not self._keys:
+            return None
+        ts = self._keys[0]
+        return ts, self._value(ts)
+
+    def last(self) -> tuple[int, Any] | None:
+        if not self._keys:
+            return None
+        ts = self._keys[-1]
+        return ts, self._value(ts)
+
+    # first stored item with a timestamp strictly greater than ts
+    def first_after(self, ts: int) -> tuple[int, Any] | None:
+        pos = bisect_right(self._keys, ts)
+        if pos == len(self._keys):
+            return None
+        ts = self._keys[pos]
+        return ts, self._value(ts)
+
+    # last stored item with a timestamp at or before ts
+    def last_at_or_before(self, ts: int) -> tuple[int, Any] | None:
+        pos = bisect_right(self._keys, ts)
+        if pos == 0:
+            return None
+        ts = self._keys[pos - 1]
+        return ts, self._value(ts)
+
+    # (ts, item) pairs in timestamp order, for lo < ts <= hi
+    def items(self, lo: int | None = None, hi: int | None = None):
+        keys = self._keys
+        start = 0 if lo is None else bisect_right(keys, lo)
+        stop = len(keys) if hi is None else bisect_right(keys, hi)
+        for ts in keys[start:stop]:
+            yield ts, self._value(ts)
+
+    # drops every item with a timestamp below `until` (or at it, if inclusive)
+    # and returns how many were dropped
+    def truncate(self, until: int, inclusive: bool = True) -> int:
+        keys = self._keys
+        stop = bisect_right(keys, until) if inclusive else bisect_left(keys, until)
+        if stop == 0:
+            return 0
+        data = self._data
+        for ts in keys[:stop]:
+            del data[ts]
+        del keys[:stop]
+        return stop
+
+
+# the items of one channel, stored once for all the readers of that channel
+# on this rank. Each reader keeps its own keeptime and items are dropped once
+# every reader has consumed them. The lock is shared by those readers.
+# With a memory_budget (in bytes, see spill.item_size), the oldest items in
+# memory are spilled to disk whenever the others would exceed it, and read
+# back from there on access.
+class _Shared_Timed_Data(_Timed_Data):
+    def __init__(self, memory_budget: int | None = None):
+        super().__init__()
+        self.lock = threading.Lock()
+        self._readers_keeptime = _PQDict_()
+        self.memory_budget = memory_budget
+        self._spill = None if memory_budget is None else _Spill()
+        # sizes of the items in memory, and a min-heap of their timestamps
+        # that may also hold timestamps of items spilled or dropped since
+        self._sizes: dict[int, int] = {}
+        self._resident: list[int] = []
+        self.resident_bytes = 0
+
+    def __getitem__(self, ts: int):
+        item = self._data.get(ts, None)
+        if type(item) is _Spilled:
+            return self._spill.read(item)
+        return item
+
+    def _value(self, ts: int) -> Any:
+        item = self._data[ts]
+        if type(item) is _Spilled:
+            return self._spill.read(item)
+        return item
+
+    def __setitem__(self, ts: int, item: Any):
+        if self._spill is None:
+            super().__setitem__(ts, item)
+            return
+        self._forget(ts)
+        super().__setitem__(ts, item)
+        size = item_size(item)
+        self._sizes[ts] = size
+        self.resident_bytes += size
+        heapq.heappush(self._resident, ts)
+        while self.resident_bytes > self.memory_budget:
+            self._spill_oldest()
+
+    def __delitem__(self, ts: int):
+        if self._spill is not None:
+            self._forget(ts)
+        super().__delitem__(ts)
+
+    def truncate(self, until: int, inclusive: bool = True) -> int:
+        if self._spill is not None:
+            keys = self._keys
+            stop = bisect_right(keys, until) if inclusive else bisect_left(keys, until)
+            for ts in keys[:stop]:
+                self._forget(ts)
+            # what is left in the heap below until was dropped
+            resident = self._resident
+            while resident and (
+                resident[0] <= until if inclusive else resident[0] < until
+            ):
+                heapq.heappop(resident)
+        return super().truncate(until, inclusive)
+
+    # releases the memory or the spilled copy of the item at ts, if any
+    def _forget(self, ts: int):
+        size = self._sizes.pop(ts, None)
+        if size is not None:
+            self.resident_bytes -= size
+            return
+        item = self._data.get(ts, None)
+        if type(item) is _Spilled:
+            self._spill.release(item)
+
+    def _spill_oldest(self):
+        ts = heapq.heappop(self._resident)
+        while ts not in self._sizes:
+            ts = heapq.heappop(self._resident)
+        self._data[ts] = self._spill.write(self._data[ts])
+        self.resident_bytes -= self._sizes.pop(ts)
+
+    @property
+    def n_spilled(self) -> int:
+        return 0 if self._spill is None else self._spill.n_items
+
+    def add_reader(self, reader_name: str):
+        self._readers_keeptime[reader_name] = 0
+
+    def keeptime(self) -> int:
+        _, ts = self._readers_keeptime.peek()
+        return ts
+
+    # must be called with self.lock held, returns how many items were dropped
+    def consume(self, reader_name: str, until: int) -> int:
+        prev_keeptime = self.keeptime()
+        self._readers_keeptime[reader_name] = until
+        keeptime = self.keeptime()
+        if keeptime <= prev_keeptime:
+            return 0
+        return self.truncate(keeptime)
+
+
+# a _Shared_Timed_Data for latest-value channels, which only holds the
+# newest `keep_last` items. Storing an item drops the oldest one past that,
+# whether the readers consumed it or not, and an item older than all of
+# those held is not stored. Readers waiting on a timestamp that was not
+# stored are left to the advance past it (see _Local_Readers._wake).
+class _Latest_Timed_Data(_Shared_Timed_Data):
+    def __init__(self, keep_last: int, memory_budget: int | None = None):
+        super().__init__(memory_budget)
+        self.keep_last = keep_last
+        self.n_overwritten = 0
+
+    def __setitem__(self, ts: int, item: Any):
+        keys = self._keys
+        if len(keys) >= self.keep_last and ts < keys[0]:
+            self.n_overwritten += 1
+            return
+        super().__setitem__(ts, item)
+        if len(keys) > self.keep_last:
+            del self[keys[0]]
+            self.n_overwritten += 1
+
+
+# the timestamps a reader needs, channels only send those to its rank: the
+# multiples of `stride` in [start, stop). A `latest` reader only needs items
+# newer than the last one it got, receiving ts consumes everything before it.
+# The subscription is sent as integers at build time.
+@dataclass(slots=True)
+class _Subscription:
+    stride: int = 1
+    start: int = -(2**63)
+    stop: int = 2**63 - 1
+    latest: bool = False
+
+    WIDTH = 4  # of .encode
+
+    # None when every timestamp is needed
+    @classmethod
+    def of(
+        cls,
+        stride: int | None = None,
+        window: tuple[int, int] | None = None,
+        latest: bool = False,
+    ) -> "_Subscription | None":
+        subscription = cls(latest=latest)
+        if stride is not None:
+            if stride < 1:
+                raise ValueError("stride must be at least 1")
+            subscription.stride = stride
+        if window is not None:
+            start, stop = window
+            if stop < start:
+                raise ValueError("window must be a (start, stop) range")
+            subscription.start, subscription.stop = start, stop
+        return None if subscription == cls() else subscription
+
+    def matches(self, ts: int) -> bool:
+        return self.start <= ts < self.stop and ts % self.stride == 0
+
+    def encode(self) -> tuple[int, ...]:
+        return (self.stride, self.start, self.stop, int(self.latest))
+
+    @classmethod
+    def decode(cls, values: tuple[int, ...]) -> "_Subscription | None":
+        stride, start, stop, latest = values
+        subscription = cls(stride, start, stop, bool(latest))
+        return None if subscription == cls() else subscription
+
+
+# the items of a typed channel: a fixed `shape` of a NumPy `dtype`, of which
+# `capacity` timestamps are kept. Items of `persistent` channels are sent on
+# persistent links. The spec is sent as integers at build time, dtypes as
+# the (at most 8) characters of their dtype.str.
+@dataclass(slots=True)
+class _Ring_Spec:
+    dtype: str
+    shape: tuple[int, ...]
+    capacity: int
+    persistent: bool = False
+
+    MAX_DIMS = 4
+    WIDTH = 3 + MAX_DIMS  # of .encode
+
+    def encode(self) -> tuple[int, ...]:
+        code = int.from_bytes(self.dtype.encode().ljust(8, b"\0"), "little")
+        dims = self.shape + (-1,) * (self.MAX_DIMS - len(self.shape))
+        return (code, self.capacity, int(self.persistent), *dims)
+
+    @classmethod
+    def decode(cls, values: tuple[int, ...]) -> "_Ring_Spec | None":
+        code, capacity, persistent, *dims = values
+        if code == 0:
+            return None
+        dtype = code.to_bytes(8, "little").rstrip(b"\0").decode()
+        shape = tuple(dim for dim in dims if dim >= 0)
+        return cls(dtype, shape, capacity, bool(persistent))
+
+
+# a _Shared_Timed_Data for typed channels. Items are copied into a ring of
+# preallocated rows, the row of ts being ts % capacity, so storing them does
+# not allocate. The ring holds the timestamps in (head, head + capacity], the
+# head follows the keeptime of the readers. An item past the end of the ring
+# overwrites the oldest ones, even if some reader has not consumed them yet.
+# Readers waiting on those are left to the advance past them.
+class _Ring_Timed_Data(_Shared_Timed_Data):
+    EMPTY = -(2**63)
+
+    def __init__(self, spec: _Ring_Spec):
+        super().__init__()
+        import numpy
+
+        self._numpy = numpy
+        self.spec = spec
+        self.values = numpy.zeros((spec.capacity, *spec.shape), dtype=spec.dtype)
+        # the timestamp held by each row
+        self._ts = numpy.full(spec.capacity, self.EMPTY, dtype=numpy.int64)
+        self._head = 0
+        self._last = self.EMPTY
+        self._n = 0
+        self.n_overwritten = 0
+
+    def __len__(self):
+        return self._n
+
+    def __contains__(self, ts: int):
+        return ts > self._head and self._ts[ts % self.spec.capacity] == ts
+
+    def __getitem__(self, ts: int):
+        if ts not in self:
+            return None
+        return self.values[ts % self.spec.capacity].copy()
+
+    def _value(self, ts: int) -> Any:
+        return self.values[ts % self.spec.capacity].copy()
+
+    def __setitem__(self, ts: int, item: Any):
+        if ts <= self._head:
+            return
+        numpy = self._numpy
+        try:
+            item = numpy.broadcast_to(
+                numpy.asarray(item, dtype=self.values.dtype), self.spec.shape
+            )
+        except (TypeError, ValueError):
+            logger.error(f"item at ts={ts} does not fit {self.spec}, dropped")
+            return
+        capacity = self.spec.capacity
+        if ts > self._head + capacity:
+            dropped = self.truncate(ts - capacity)
+            if dropped:
+                self.n_overwritten += dropped
+                logger.warning(
+                    f"{dropped} unconsumed items overwritten in a ring of {capacity}"
+                )
+        row = ts % capacity
+        self.values[row] = item
+        if self._ts[row] != ts:
+            self._ts[row] = ts
+            self._n += 1
+        if ts > self._last:
+            self._last = ts
+
+    def __delitem__(self, ts: int):
+        if ts in self:
+            self._ts[ts % self.spec.capacity] = self.EMPTY
+            self._n -= 1
+
+    # timestamps in lo < ts <= hi that hold an item, as an array
+    def _stored(self, lo: int, hi: int):
+        numpy = self._numpy
+        lo = max(lo, self._head)
+        hi = min(hi, self._last)
+        if hi <= lo:
+            return numpy.empty(0, dtype=numpy.int64)
+        ts = numpy.arange(lo + 1, hi + 1, dtype=numpy.int64)
+        return ts[self._ts[ts % self.spec.capacity] == ts]
+
+    def first(self) -> tuple[int, Any] | None:
+        return self.first_after(self._head)
+
+    def last(self) -> tuple[int, Any] | None:
+        if self._n == 0:
+            return None
+        if self._last not in self:
+            self._last = int(self._stored(self._head, self._last)[-1])
+        return self._last, self._value(self._last)
+
+    def first_after(self, ts: int) -> tuple[int, Any] | None:
+        stored = self._stored(ts, self._last)
+        if len(stored) == 0:
+            return None
+        ts = int(stored[0])
+        return ts, self._value(ts)
+
+    def last_at_or_before(self, ts: int) -> tuple[int, Any] | None:
+        if ts >= self._last:
+            return self.last()
+        stored = self._stored(self._head, ts)
+        if len(stored) == 0:
+            return None
+        ts = int(stored[-1])
+        return ts, self._value(ts)
+
+    def items(self, lo: int | None = None, hi: int | None = None):
+        lo = self._head if lo is None else lo
+        hi = self._last if hi is None else hi
+        for ts in self._stored(lo, hi).tolist():
+            yield ts, self._value(ts)
+
+    # moves the head of the ring to `until`, the rows are left as they are
+    def truncate(self, until: int, inclusive: bool = True) -> int:
+        head = until if inclusive else until - 1
+        if head <= self._head:
+            return 0
+        stored = self._stored(self._head, head)
+        self._ts[stored % self.spec.capacity] = self.EMPTY
+        self._n -= len(stored)
+        self._head = head
+        return len(stored)
+
+    # the rows of lo <= ts < hi, as a view of the ring when they do not wrap
+    # around its end, and which of them hold an item with ts > keeptime
+    def range(self, lo: int, hi: int, keeptime: int):
+        numpy = self._numpy
+        capacity = self.spec.capacity
+        if hi - lo > capacity:
+            raise ValueError(f"the range is larger than the capacity ({capacity})")
+        hi = max(lo, hi)
+        ts = numpy.arange(lo, hi, dtype=numpy.int64)
+        rows = ts % capacity
+        start = lo % capacity
+        if start + (hi - lo) <= capacity:
+            values = self.values[start : start + (hi - lo)]
+        else:
+            values = self.values[rows]
+        received = (self._ts[rows] == ts) & (ts > max(keeptime, self._head))
+        return values, received
@@ -0,0 +1,101 @@
+import array
+import hashlib
+from collections.abc import Iterable
+from itertools import accumulate
+from mpi4py import MPI
+
+
+# channel names are only ever sent as 64-bit keys, and the directory entry of
+# a channel lives on the rank given by its key, so any rank can find it
+def channel_key(name: str) -> int:
+    digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def directory_rank(key: int, size: int) -> int:
+    return key % size
+
+
+# sends `send[rank]` to each rank and returns what the ranks sent to this
+# one, as rank -> data. Only the sizes go to every rank, with one Alltoall
+# of integers, the data only goes where it is sent to, with an Alltoallv.
+def exchange(comm: MPI.Comm, send: dict[int, bytes]) -> dict[int, bytes]:
+    size = comm.Get_size()
+    send_counts = array.array("q", bytes(8 * size))
+    for rank, data in send.items():
+        send_counts[rank] = len(data)
+    recv_counts = array.array("q", bytes(8 * size))
+    comm.Alltoall([send_counts, MPI.INT64_T], [recv_counts, MPI.INT64_T])
+    send_displs = [0, *accumulate(send_counts)][:-1]
+    recv_displs = [0, *accumulate(recv_counts)][:-1]
+    send_buf = b"".join(send[rank] for rank in sorted(send))
+    recv_buf = bytearray(sum(recv_counts))
+    comm.Alltoallv(
+        [send_buf, (list(send_counts), send_displs), MPI.BYTE],
+        [recv_buf, (list(recv_counts), recv_displs), MPI.BYTE],
+    )
+    return {
+        rank: bytes(recv_buf[recv_displs[rank] : recv_displs[rank] + count])
+        for rank, count in enumerate(recv_counts)
+        if count
+    }
+
+
+# like exchange, for records of `width` 64-bit integers
+def exchange_records(
+    comm: MPI.Comm, send: dict[int, list[tuple[int, ...]]], width: int
+) -> dict[int, list[tuple[int, ...]]]:
+    packed = {
+        rank: array.array("q", [value for record in records for value in record])
+        for rank, records in send.items()
+        if records
+    }
+    received = exchange(comm, {rank: a.tobytes() for rank, a in packed.items()})
+    records: dict[int, list[tuple[int, ...]]] = {}
+    for rank, data in received.items():
+        values = array.array("q")
+        values.frombytes(data)
+        records[rank] = [
+            tuple(values[i : i + width]) for i in range(0, len(values), width)
+        ]
+    return records
+
+
+# replies of the directory to a lookup, in place of a shard index
+UNKNOWN = -1
+DUPLICATE = -2
+
+
+class _Channel_Directory:
+    """
+    The share of the channel directory held by one rank, for the channels
+    whose keys map to it. The ranks hosting channels register them, as
+    records of `width` integers: key, shard index, number of shards, channel
+    id, then what the ranks of its readers need to know. Every shard of a
+    sharded channel is registered under the key of the channel. Lookups are
+    answered with the records of all the shards.
+
+    """
+
+    def __init__(self, width: int):
+        self._width = width
+        self._entries: dict[int, list[tuple[int, ...]]] = {}
+
+    def register(self, records: Iterable[tuple[int, ...]]):
+        for record in records:
+            self._entries.setdefault(record[0], []).append(record)
+
+    def _valid(self, entries: list[tuple[int, ...]]) -> bool:
+        n_shards = entries[0][2]
+        return all(entry[2] == n_shards for entry in entries) and sorted(
+            entry[1] for entry in entries
+        ) == list(range(n_shards))
+
+    def lookup(self, key: int) -> list[tuple[int, ...]]:
+        entries = self._entries.get(key)
+        padding = (0,) * (self._width - 2)
+        if entries is None:
+            return [(key, UNKNOWN, *padding)]
+        if not self._valid(entries):
+            return [(key, DUPLICATE, *padding)]
+        return entries
@@ -0,0 +1,81 @@
+import queue
+import threading
+from collections.abc import Callable, Iterable
+from typing import Any
+
+from .log import logger
+
+
+class _Channel_Executor:
+    """
+    Processes messages on a pool of worker threads, sharded by channel.
+    The messages of a channel always go to the same worker and are processed
+    in the order they were submitted, while unrelated channels run in parallel.
+    The channels of the rank are dealt to the workers in turn, by a dense
+    index of their own: their ids may all be the same modulo the number of
+    workers (with build(scalable=True), they are all RANK modulo SIZE).
+    A batch that fails is logged and the worker goes on with the next one,
+    the first error is kept in .error.
+
+    """
+
+    # messages a worker takes from its queue to process as a single batch
+    BATCH_SIZE = 64
+
+    def __init__(
+        self,
+        n_workers: int,
+        process: Callable[[list[Any]], None],
+        channel_ids: Iterable[int] = (),
+    ):
+        self._process = process
+        self._indices = {channel_id: i for i, channel_id in enumerate(channel_ids)}
+        self.error: Exception | None = None
+        self._queues: list[queue.SimpleQueue] = [
+            queue.SimpleQueue() for _ in range(n_workers)
+        ]
+        self._threads = [
+            threading.Thread(target=self._work, args=(q,)) for q in self._queues
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def __len__(self):
+        return len(self._queues)
+
+    # messages submitted and not taken by a worker yet
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def submit(self, channel_id: int, msg: Any):
+        index = self._indices.get(channel_id, channel_id)
+        self._queues[index % len(self._queues)].put(msg)
+
+    def _work(self, q: queue.SimpleQueue):
+        stop = False
+        while not stop:
+            msgs = [q.get()]
+            while len(msgs) < self.BATCH_SIZE:
+                try:
+                    msgs.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            # nothing is submitted after the None of .shutdown
+            if msgs[-1] is None:
+                msgs.pop()
+                stop = True
+            if not msgs:
+                continue
+            try:
+                self._process(msgs)
+            except Exception as e:
+                logger.exception(f"worker failed to process {len(msgs)} messages")
+                if self.error is None:
+                    self.error = e
+
+    # waits until the workers processed every message submitted so far
+    def shutdown(self):
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,76 @@
+import heapq
+import itertools
+import threading
+import time
+from collections.abc import Callable
+
+from .log import logger
+
+
+class _Flusher:
+    """
+    Runs the flushes scheduled by the connections of an STM instance, such
+    as advances held back by a control_delay and puts buffered for a
+    batch_delay, once they are due. A single thread serves every connection,
+    it is started by the first flush scheduled and runs until .stop.
+
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        # entries are [due time, sequence number, flush], a cancelled entry
+        # loses its flush and is dropped once it is due
+        self._heap: list[list] = []
+        self._seq = itertools.count()
+        self._thread: threading.Thread | None = None
+        self._stopped = False
+
+    # `flush` is called from the thread of the flusher, `delay` seconds from
+    # now. Returns the entry to pass to .cancel.
+    def schedule(self, delay: float, flush: Callable[[], None]) -> list:
+        entry = [time.monotonic() + delay, next(self._seq), flush]
+        with self._cond:
+            if self._stopped:
+                return entry
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            elif self._heap[0] is entry:
+                self._cond.notify()
+        return entry
+
+    def cancel(self, entry: list):
+        entry[2] = None
+
+    def _run(self):
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                wait = self._heap[0][0] - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                _, _, flush = heapq.heappop(self._heap)
+                if flush is None:
+                    continue
+                # connections schedule flushes while holding their own lock
+                self._cond.release()
+                try:
+                    flush()
+                except Exception:
+                    logger.exception("scheduled flush failed")
+                finally:
+                    self._cond.acquire()
+
+    # pending flushes are dropped, the connections flush on their own when
+    # the STM instance stops
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._heap = []
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
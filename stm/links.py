@@ -0,0 +1,220 @@
+import math
+import struct
+import time
+from mpi4py import MPI
+from typing import Any
+
+from .data import _Ring_Spec
+from .messaging import _Message_Channel_Put, _Message_Reader_Data
+
+
+# records sent on persistent links: ts, put_time and flags telling whether it
+# is set, then the item. The header is padded to keep items aligned. Records
+# never carry an advance: a put that does not fit its link is sent as a
+# message, which may overtake records sent before it, so advances are only
+# sent as control messages, held back until the puts before them arrive.
+_HEADER = struct.Struct("<qdq8x")
+_HAS_PUT_TIME = 1
+
+# links of both kinds share a communicator. The tags of writer links are
+# assigned by the writer ranks and those of reader links by the reader ranks,
+# so their parity keeps them apart.
+WRITER_LINK = 0
+READER_LINK = 1
+
+
+def link_tag(index: int, kind: int) -> int:
+    tag = 2 * index + kind
+    if tag > MPI.COMM_WORLD.Get_attr(MPI.TAG_UB):
+        raise ValueError("too many persistent links on this rank")
+    return tag
+
+
+class _Link:
+    """
+    A persistent link of a typed channel, from a writer to the channel or
+    from the channel to a reader rank. Every item is sent as a record of the
+    same size, through one of SLOTS buffers with a persistent request each,
+    set up once at build time. The requests are created by .init, on the
+    communicator of the instance.
+
+    """
+
+    SLOTS = 4
+
+    def __init__(self, spec: _Ring_Spec, rank: int, tag: int):
+        import numpy
+
+        self.spec = spec
+        self.rank = rank
+        self.tag = tag
+        dtype = numpy.dtype(spec.dtype)
+        n_values = math.prod(spec.shape)
+        self.size = _HEADER.size + dtype.itemsize * n_values
+        self._buffers = [bytearray(self.size) for _ in range(self.SLOTS)]
+        self._items = [
+            numpy.frombuffer(buf, dtype, n_values, _HEADER.size).reshape(spec.shape)
+            for buf in self._buffers
+        ]
+        self._reqs: list[MPI.Request] = []
+        # slots are used in turn, the next one is the oldest
+        self._next = 0
+
+    def free(self):
+        for req in self._reqs:
+            req.Free()
+        self._reqs = []
+
+
+class _Send_Link(_Link):
+    def __init__(self, spec: _Ring_Spec, rank: int, tag: int):
+        super().__init__(spec, rank, tag)
+        self.n_sent = 0
+
+    def init(self, comm: MPI.Comm):
+        self._reqs = [
+            comm.Send_init([buf, MPI.BYTE], dest=self.rank, tag=self.tag)
+            for buf in self._buffers
+        ]
+
+    # returns False, without sending anything, when the oldest slot is still
+    # in flight or the item does not fit the channel
+    def start(self, ts: int, item: Any, put_time: float | None) -> bool:
+        i = self._next
+        req = self._reqs[i]
+        # inactive persistent requests, never started ones included, test true
+        if not req.Test():
+            return False
+        try:
+            self._items[i][...] = item
+        except (TypeError, ValueError):
+            return False
+        flags = _HAS_PUT_TIME if put_time is not None else 0
+        _HEADER.pack_into(self._buffers[i], 0, ts, put_time or 0.0, flags)
+        req.Start()
+        self._next = (i + 1) % self.SLOTS
+        self.n_sent += 1
+        return True
+
+    def wait_all(self):
+        MPI.Request.Waitall(self._reqs)
+
+
+class _Receive_Link(_Link):
+    """
+    The receiving end of a link, whose records are turned back into the
+    messages of the regular path: puts of `writer_id` for writer links, and
+    data for the readers of the rank otherwise.
+
+    """
+
+    def __init__(
+        self,
+        spec: _Ring_Spec,
+        rank: int,
+        tag: int,
+        channel_id: int,
+        writer_id: int | None = None,
+    ):
+        super().__init__(spec, rank, tag)
+        self.channel_id = channel_id
+        self.writer_id = writer_id
+        self._done = [False] * self.SLOTS
+
+    def init(self, comm: MPI.Comm):
+        self._reqs = [
+            comm.Recv_init([buf, MPI.BYTE], source=self.rank, tag=self.tag)
+            for buf in self._buffers
+        ]
+        MPI.Prequest.Startall(self._reqs)
+
+    # records are matched to the slots in the order they were started, and
+    # taken in that order. A slot is restarted once its record is taken.
+    def take(self) -> list[Any]:
+        msgs = []
+        while self._done[self._next]:
+            i = self._next
+            ts, put_time, flags = _HEADER.unpack_from(self._buffers[i])
+            item = self._items[i].copy()
+            self._done[i] = False
+            self._reqs[i].Start()
+            self._next = (i + 1) % self.SLOTS
+            if not flags & _HAS_PUT_TIME:
+                put_time = None
+            if self.writer_id is None:
+                msg = _Message_Reader_Data(ts, item, self.channel_id, None, put_time)
+            else:
+                msg = _Message_Channel_Put(
+                    ts,
+                    item,
+                    self.rank,
+                    self.channel_id,
+                    self.writer_id,
+                    None,
+                    put_time,
+                )
+            msgs.append(msg)
+        return msgs
+
+    # receives still posted at shutdown are cancelled
+    def cancel(self):
+        for req in self._reqs:
+            if not req.Test():
+                req.Cancel()
+        MPI.Request.Waitall(self._reqs)
+
+
+class _Receive_Links:
+    """
+    The receiving ends of the links of a rank, polled by the listener next to
+    its probes, with a single Testsome over the slots of every link.
+
+    """
+
+    def __init__(self):
+        self._links: list[_Receive_Link] = []
+        self._reqs: list[MPI.Request] = []
+        self._slots: list[tuple[_Receive_Link, int]] = []
+        # time.monotonic() when records last arrived
+        self.received_at = 0.0
+
+    def __bool__(self):
+        return bool(self._links)
+
+    def add(self, link: _Receive_Link):
+        self._links.append(link)
+
+    def init(self, comm: MPI.Comm):
+        for link in self._links:
+            link.init(comm)
+            self._reqs.extend(link._reqs)
+            self._slots.extend((link, i) for i in range(link.SLOTS))
+
+    # the messages of the records that have arrived, and their total size
+    def receive(self) -> tuple[list[Any], int]:
+        if not self._links:
+            return [], 0
+        done = MPI.Request.Testsome(self._reqs)
+        if not done:
+            return [], 0
+        self.received_at = time.monotonic()
+        links = {}
+        for i in done:
+            link, slot = self._slots[i]
+            link._done[slot] = True
+            links[id(link)] = link
+        msgs = []
+        nbytes = 0
+        for link in links.values():
+            taken = link.take()
+            msgs.extend(taken)
+            nbytes += link.size * len(taken)
+        return msgs, nbytes
+
+    def close(self):
+        for link in self._links:
+            link.cancel()
+            link.free()
+        self._links = []
+        self._reqs = []
+        self._slots = []
@@ -1,46 +1,220 @@
+import pickle
+import struct
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, ClassVar
 
+from .data import _Ring_Spec, _Subscription
 
+
+# tags of the messages on the communicator of an STM instance. Control
+# messages (consumes and advances) have their own tag so that the listener
+# can serve them ahead of the data waiting in the queue, and the shutdown
+# shares the data tag so that it never overtakes the data of its rank.
 class STM_Tag:
     STM_DATA = 1
+    STM_CONTROL = 2
+    # out-of-band buffers are sent on tags in [STM_BUFFER, STM_BUFFER + STM_BUFFER_TAGS),
+    # on a communicator of their own
+    STM_BUFFER = 3
+    STM_BUFFER_TAGS = 16384
+
 
+# message types, _STM.process_message dispatches on these
+class STM_Msg:
+    SHUTDOWN = 1
+    CONSUME = 2
+    ADVANCE = 3
+    PUT = 4
+    PUT_BATCH = 5
+    DATA = 6
+    DATA_BATCH = 7
+    RELAY = 8
+    BUFFERS = 9
+    SHARED = 10
+    SUBSCRIBE = 11
 
-@dataclass
+
+@dataclass(slots=True)
 class _Message_STM_Channels_Init:
     channels: list[str]
     source_rank: int
+    n_readers: int
+    n_writers: int
+    # of each channel, for the reader stores of the other ranks
+    memory_budgets: list[int | None]
+    rings: list[_Ring_Spec | None]
+    keep_lasts: list[int | None]
+    # channels sharded by timestamp, as (name, shards, arguments of _Channel),
+    # their shards are hosted by the ranks following source_rank
+    sharded: list[tuple[str, int, tuple]]
 
 
-@dataclass
+@dataclass(slots=True)
 class _Message_STM_Shutdown:
+    TYPE: ClassVar[int] = STM_Msg.SHUTDOWN
     source_rank: int
 
+    def _pack(self) -> bytes:
+        return _CONTROL.pack(self.TYPE, self.source_rank, 0, 0, 0)
+
 
-@dataclass
+# channels, readers and writers are identified by the dense integer ids
+# assigned by STMBuilder.build, rather than by their names.
+# data messages can carry an advance of the writer (or of the channel, to the
+# readers), applied after the data, instead of a separate advance message.
+# `put_time` is the time.time() the writer sent the put at, for latency stats.
+@dataclass(slots=True)
 class _Message_Channel_Put:
+    TYPE: ClassVar[int] = STM_Msg.PUT
     ts: int
     item: Any
     source_rank: int
-    channel_name: str
+    channel_id: int
+    writer_id: int
+    advance: int | None = None
+    put_time: float | None = None
 
 
-@dataclass
+@dataclass(slots=True)
+class _Message_Channel_Put_Batch:
+    TYPE: ClassVar[int] = STM_Msg.PUT_BATCH
+    items: list[tuple[int, Any]]
+    source_rank: int
+    channel_id: int
+    writer_id: int
+    advance: int | None = None
+    put_time: float | None = None
+
+
+@dataclass(slots=True)
 class _Message_Reader_Data:
+    TYPE: ClassVar[int] = STM_Msg.DATA
     ts: int
     item: Any
-    channel_name: str
+    channel_id: int
+    advance: int | None = None
+    put_time: float | None = None
+
 
+@dataclass(slots=True)
+class _Message_Reader_Data_Batch:
+    TYPE: ClassVar[int] = STM_Msg.DATA_BATCH
+    items: list[tuple[int, Any]]
+    channel_id: int
+    advance: int | None = None
+    put_time: float | None = None
 
-@dataclass
+
+@dataclass(slots=True)
 class _Message_Reader_Consume:
+    TYPE: ClassVar[int] = STM_Msg.CONSUME
     until: int
-    reader_name: str
-    channel_name: str
+    reader_id: int
+    channel_id: int
+
+    def _pack(self) -> bytes:
+        return _CONTROL.pack(
+            self.TYPE, self.until, self.reader_id, self.channel_id, 0
+        )
+
+
+# replaces the subscription of a reader, None subscribes it to everything
+@dataclass(slots=True)
+class _Message_Reader_Subscribe:
+    TYPE: ClassVar[int] = STM_Msg.SUBSCRIBE
+    subscription: _Subscription | None
+    reader_id: int
+    channel_id: int
 
 
-@dataclass
+# advances can overtake the data sent before them, since they travel on the
+# control tag. `seq` is the number of data messages sent before the advance
+# on the same path (writer to channel, or channel to reader rank), the
+# advance is held back until that many have been received.
+@dataclass(slots=True)
 class _Message_Writer_Advance:
+    TYPE: ClassVar[int] = STM_Msg.ADVANCE
     until: int
-    writer_name: str
-    channel_name: str
+    writer_id: int
+    channel_id: int
+    seq: int = 0
+
+    def _pack(self) -> bytes:
+        return _CONTROL.pack(
+            self.TYPE, self.until, self.writer_id, self.channel_id, self.seq
+        )
+
+
+# a message for the receiving rank, which must also relay it to `ranks`
+# through a `fanout`-ary tree
+@dataclass(slots=True)
+class _Message_Relay:
+    TYPE: ClassVar[int] = STM_Msg.RELAY
+    msg: Any
+    ranks: list[int]
+    fanout: int
+
+
+# header for a message whose large buffers are sent out-of-band,
+# `data` is the pickle (protocol 5) of the message without those buffers
+@dataclass(slots=True)
+class _Message_Buffers:
+    TYPE: ClassVar[int] = STM_Msg.BUFFERS
+    data: bytes
+    buffer_sizes: list[int]
+    buffer_tag: int
+    source_rank: int
+
+
+# notification for a message written to the shared memory ring `name`, at
+# `position`, as its pickle (protocol 5) followed by its out-of-band buffers
+@dataclass(slots=True)
+class _Message_Shared:
+    TYPE: ClassVar[int] = STM_Msg.SHARED
+    channel_id: int
+    name: str
+    position: int
+    data_size: int
+    buffer_sizes: list[int]
+
+
+# control messages are packed as (type, value, id, channel id, seq) instead of
+# being pickled. Their first byte is the message type, which can't be mistaken
+# for the PROTO opcode every protocol 5 pickle starts with.
+_CONTROL = struct.Struct("<Bqiiq")
+_PICKLE_PROTO = pickle.PROTO[0]
+
+
+# returns None for messages that must be pickled
+def encode_control(msg: Any) -> bytes | None:
+    if type(msg) not in _CONTROL_CLASSES:
+        return None
+    return msg._pack()
+
+
+def decode(data) -> Any:
+    if data[0] == _PICKLE_PROTO:
+        return pickle.loads(data)
+    msg_type, value, conn_id, channel_id, seq = _CONTROL.unpack_from(data)
+    if msg_type == STM_Msg.SHUTDOWN:
+        return _Message_STM_Shutdown(value)
+    if msg_type == STM_Msg.ADVANCE:
+        return _Message_Writer_Advance(value, conn_id, channel_id, seq)
+    return _CONTROL_TYPES[msg_type](value, conn_id, channel_id)
+
+
+_CONTROL_TYPES = {
+    STM_Msg.SHUTDOWN: _Message_STM_Shutdown,
+    STM_Msg.CONSUME: _Message_Reader_Consume,
+    STM_Msg.ADVANCE: _Message_Writer_Advance,
+}
+_CONTROL_CLASSES = frozenset(_CONTROL_TYPES.values())
+
+
+# the tag a message is sent on, relayed control messages keep their tag
+def message_tag(msg: Any) -> int:
+    if type(msg) is _Message_Relay:
+        msg = msg.msg
+    if type(msg) in _CONTROL_CLASSES and type(msg) is not _Message_STM_Shutdown:
+        return STM_Tag.STM_CONTROL
+    return STM_Tag.STM_DATA
@@ -0,0 +1,126 @@
+import itertools
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import threading
+from typing import Any
+
+from .messaging import _Message_Shared
+
+
+# rings are plain files in a memory-backed file system, so that every rank
+# of the node can map them; unlinking a ring leaves existing maps valid
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+# the bytes of the ring of each (channel rank, reader rank) pair, pages are
+# only backed by memory once written. A message that does not fit in the
+# space left goes through MPI instead.
+RING_SIZE = 64 * 1024 * 1024
+
+# the ring starts with its head (the position after the last message written)
+# and its tail (the position after the last message read), each only written
+# by its own side. Positions only grow, their offset in the ring is modulo
+# RING_SIZE.
+_POSITION = struct.Struct("<q")
+_HEAD, _TAIL = 0, 8
+_HEADER_SIZE = 64
+
+_ring_ids = itertools.count()
+
+
+# pickles `msg` once for the rings of every reader rank
+def pack(msg: Any) -> tuple[bytes, list[memoryview]]:
+    buffers: list[pickle.PickleBuffer] = []
+    data = pickle.dumps(msg, protocol=5, buffer_callback=buffers.append)
+    return data, [buf.raw() for buf in buffers]
+
+
+def _map(name: str, size: int | None = None) -> mmap.mmap:
+    path = os.path.join(SHM_DIR, name)
+    if size is None:
+        fd = os.open(path, os.O_RDWR)
+    else:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+    try:
+        if size is not None:
+            os.ftruncate(fd, size)
+        return mmap.mmap(fd, 0)
+    finally:
+        os.close(fd)
+
+
+class _Ring_Writer:
+    """
+    The sending end of the ring of a reader rank of the same node, created
+    at build time. The channels of the rank share it, each message is written
+    to the head of the ring and the reader frees it by moving the tail once
+    it has copied it out.
+
+    """
+
+    def __init__(self, rank: int, reader_rank: int):
+        ring_id = next(_ring_ids)
+        self.name = f"stm-ring-{os.getpid()}-{rank}-{reader_rank}-{ring_id}"
+        self._mm = _map(self.name, _HEADER_SIZE + RING_SIZE)
+        self._head = 0
+        # channels run on several workers in the "executor" mode
+        self._lock = threading.Lock()
+
+    # None if the ring has no room for the message
+    def write(
+        self, channel_id: int, data: bytes, raws: list[memoryview]
+    ) -> _Message_Shared | None:
+        sizes = [raw.nbytes for raw in raws]
+        size = len(data) + sum(sizes)
+        with self._lock:
+            position = self._head
+            offset = position % RING_SIZE
+            # messages are contiguous, the end of the ring is skipped if needed
+            if offset + size > RING_SIZE:
+                position += RING_SIZE - offset
+                offset = 0
+            (tail,) = _POSITION.unpack_from(self._mm, _TAIL)
+            if position + size - tail > RING_SIZE:
+                return None
+            start = _HEADER_SIZE + offset
+            self._mm[start : start + len(data)] = data
+            start += len(data)
+            for raw in raws:
+                self._mm[start : start + raw.nbytes] = raw
+                start += raw.nbytes
+            self._head = position + size
+            _POSITION.pack_into(self._mm, _HEAD, self._head)
+        return _Message_Shared(channel_id, self.name, position, len(data), sizes)
+
+    def unlink(self):
+        os.unlink(os.path.join(SHM_DIR, self.name))
+
+
+class _Ring_Reader:
+    """
+    The receiving end of the ring of a channel rank of the same node. The
+    notifications of a rank are read in the order they were sent, so each
+    message read frees the ring up to its end.
+
+    """
+
+    def __init__(self, name: str):
+        self._mm = _map(name)
+        self._view = memoryview(self._mm)
+
+    # rebuilds the message from a copy of it, so that its space can be
+    # written again while the readers keep its items
+    def read(self, header: _Message_Shared) -> Any:
+        start = _HEADER_SIZE + header.position % RING_SIZE
+        data = self._view[start : start + header.data_size]
+        start += header.data_size
+        buffers = []
+        for size in header.buffer_sizes:
+            buffers.append(bytearray(self._view[start : start + size]))
+            start += size
+        msg = pickle.loads(data, buffers=buffers)
+        end = header.position + header.data_size + sum(header.buffer_sizes)
+        _POSITION.pack_into(self._mm, _TAIL, end)
+        return msg
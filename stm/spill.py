@@ -0,0 +1,119 @@
+import itertools
+import mmap
+import os
+import pickle
+import sys
+import tempfile
+from dataclasses import dataclass
+from typing import Any
+
+
+# spilled items go to disk, unlike shared memory segments
+SPILL_DIR = tempfile.gettempdir()
+
+# a new segment file is started once the current one reaches this size, so
+# that segments can be deleted as the items in them are dropped
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+_segment_ids = itertools.count()
+
+
+# the memory an item is charged for against a budget. Buffer-protocol objects
+# (e.g. numpy arrays), bytes and str count their data, anything else only
+# counts its own object, not what it refers to.
+def item_size(item: Any) -> int:
+    nbytes = getattr(item, "nbytes", None)
+    if isinstance(nbytes, int):
+        return nbytes
+    if isinstance(item, (bytes, bytearray, str)):
+        return len(item)
+    return sys.getsizeof(item)
+
+
+class _Segment:
+    def __init__(self):
+        self.path = os.path.join(
+            SPILL_DIR, f"stm-spill-{os.getpid()}-{next(_segment_ids)}"
+        )
+        self.fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+        # the file lives on through its descriptor, and is gone with the
+        # process however it ends
+        os.unlink(self.path)
+        self.size = 0
+        self.n_items = 0
+        self._map: mmap.mmap | None = None
+
+    def append(self, data: bytes, raws: list[memoryview]) -> int:
+        offset = self.size
+        os.pwrite(self.fd, data, offset)
+        position = offset + len(data)
+        for raw in raws:
+            os.pwrite(self.fd, raw, position)
+            position += raw.nbytes
+        self.size = position
+        self.n_items += 1
+        return offset
+
+    def view(self, offset: int, size: int) -> memoryview:
+        if self._map is None or len(self._map) < offset + size:
+            # the previous map is released once nothing refers to it anymore
+            self._map = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+        return memoryview(self._map)[offset : offset + size]
+
+    # existing maps stay valid
+    def delete(self):
+        os.close(self.fd)
+        self._map = None
+
+
+@dataclass(slots=True)
+class _Spilled:
+    segment: _Segment
+    offset: int
+    data_size: int
+    buffer_sizes: list[int]
+
+
+class _Spill:
+    """
+    Append-only segment files that items evicted from memory are written to,
+    as their pickle (protocol 5) followed by their out-of-band buffers.
+    Reading an item maps its segment, its buffers (e.g. numpy arrays) are
+    read-only views of the map. A segment is closed, freeing its disk space,
+    once all of its items were released.
+
+    """
+
+    def __init__(self):
+        self._segment: _Segment | None = None
+        self.n_items = 0
+
+    def write(self, item: Any) -> _Spilled:
+        buffers: list[pickle.PickleBuffer] = []
+        data = pickle.dumps(item, protocol=5, buffer_callback=buffers.append)
+        raws = [buf.raw() for buf in buffers]
+        segment = self._segment
+        if segment is None or segment.size >= SEGMENT_SIZE:
+            if segment is not None and segment.n_items == 0:
+                segment.delete()
+            segment = self._segment = _Segment()
+        offset = segment.append(data, raws)
+        self.n_items += 1
+        return _Spilled(segment, offset, len(data), [raw.nbytes for raw in raws])
+
+    def read(self, spilled: _Spilled) -> Any:
+        size = spilled.data_size + sum(spilled.buffer_sizes)
+        view = spilled.segment.view(spilled.offset, size)
+        offset = spilled.data_size
+        buffers = []
+        for buffer_size in spilled.buffer_sizes:
+            buffers.append(view[offset : offset + buffer_size])
+            offset += buffer_size
+        return pickle.loads(view[: spilled.data_size], buffers=buffers)
+
+    def release(self, spilled: _Spilled):
+        segment = spilled.segment
+        segment.n_items -= 1
+        self.n_items -= 1
+        if segment.n_items == 0 and segment is not self._segment:
+            segment.delete()
@@ -0,0 +1,72 @@
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from typing import Any
+
+from .log import logger
+
+
+# messages received by the listener of an STM instance
+@dataclass(slots=True)
+class _Receive_Stats:
+    messages: int = 0
+    bytes: int = 0
+    # messages already waiting when the listener took its last batch
+    last_batch: int = 0
+    max_batch: int = 0
+
+    def add_batch(self, n_msgs: int):
+        self.last_batch = n_msgs
+        if n_msgs > self.max_batch:
+            self.max_batch = n_msgs
+
+
+# seconds between the send of a put and its items reaching the readers of a
+# rank. Clocks of different nodes are not synchronized, so latencies between
+# nodes are only as accurate as their clocks.
+@dataclass(slots=True)
+class _Latency_Stats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def add(self, put_time: float):
+        latency = time.time() - put_time
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+
+    def as_dict(self) -> dict[str, Any]:
+        mean = self.total / self.count if self.count else 0.0
+        return {"count": self.count, "mean": mean, "max": self.max}
+
+
+# callables receiving the dict of _STM.stats, each at most once per interval
+@dataclass(slots=True)
+class _Stats_Hooks:
+    hooks: list[list] = field(default_factory=list)  # [hook, interval, last call]
+
+    def __bool__(self):
+        return bool(self.hooks)
+
+    def add(self, hook: Callable[[dict], None], interval: float):
+        self.hooks.append([hook, interval, 0.0])
+
+    def remove(self, hook: Callable[[dict], None]):
+        self.hooks = [entry for entry in self.hooks if entry[0] is not hook]
+
+    def run(self, stats: Callable[[], dict], force: bool = False):
+        now = time.monotonic()
+        snapshot = None
+        for entry in self.hooks:
+            hook, interval, last_call = entry
+            if not force and now - last_call < interval:
+                continue
+            entry[2] = now
+            if snapshot is None:
+                snapshot = stats()
+            try:
+                hook(snapshot)
+            except Exception:
+                logger.exception(f"stats hook {hook} failed")
@@ -1,18 +1,50 @@
 from collections.abc import Callable
+import logging
+import os
 import threading
 from mpi4py import MPI
 from typing import Any, Literal
 
-from .connection import _Reader, _Writer
+from .checkpoint import write_checkpoint, Checkpoint_Record
+from .connection import (
+    _Local_Readers,
+    _Reader,
+    _Sharded_Reader,
+    _Sharded_Writer,
+    _Writer,
+)
 from .channel import _Channel
+from .executor import _Channel_Executor
+from .flusher import _Flusher
+from .links import _Receive_Links
 
 from .log import logger
+from .shm import _Ring_Reader
+from .stats import _Receive_Stats, _Stats_Hooks
+from .transport import (
+    fan_out,
+    receive_buffers,
+    receive_messages,
+    _Buffer_Receives,
+    _Message_Request,
+    _Pending_Requests,
+    _STM_Comm,
+    WORLD,
+)
 from .messaging import (
+    encode_control,
     _Message_Channel_Put,
+    _Message_Channel_Put_Batch,
     _Message_Reader_Consume,
     _Message_Reader_Data,
+    _Message_Reader_Data_Batch,
+    _Message_Reader_Subscribe,
+    _Message_Buffers,
+    _Message_Relay,
+    _Message_Shared,
     _Message_STM_Shutdown,
     _Message_Writer_Advance,
+    STM_Msg,
     STM_Tag,
 )
 
@@ -25,11 +57,59 @@ SIZE = COMM.Get_size()
 class _STM:
     def __init__(self):
         self._channel_rank: dict[str, int] = {}
+        # channel ids are assigned at build time, channel id -> rank
+        self._channel_ids: dict[str, int] = {}
+        self._channel_ranks: dict[int, int] = {}
         self._local_channels: dict[str, _Channel] = {}
-        self._readers_by_channel: dict[str, list[_Reader]] = {}
+        self._channels_by_id: dict[int, _Channel] = {}
+        self._readers_by_channel: dict[int, _Local_Readers] = {}
         self._readers_by_id: dict[str, _Reader] = {}
         self._writers_by_id: dict[str, _Writer] = {}
+        # channels sharded by timestamp -> names of their shards, the readers
+        # and writers of those channels are made of a connection per shard
+        self._channel_shards: dict[str, list[str]] = {}
+        self._sharded_readers: dict[str, _Sharded_Reader] = {}
+        self._sharded_writers: dict[str, _Sharded_Writer] = {}
         self._rank_shutdown = [False] * SIZE
+        # the private communicators of this instance, set at build time
+        self._comm = WORLD
+        self._receive_stats = _Receive_Stats()
+        self._stats_hooks = _Stats_Hooks()
+        self._executor: _Channel_Executor | None = None
+        # runs the listener in the "thread" and "executor" modes
+        self._listening_thread: threading.Thread | None = None
+        # sends what connections held back once it is due, set on the
+        # connections at build time
+        self._flusher = _Flusher()
+        # relays of channel data through the fan-out tree
+        self._requests = _Pending_Requests()
+        # receiving ends of the persistent links of typed channels, set up at
+        # build time and polled along with the messages
+        self._links = _Receive_Links()
+        # out-of-band buffers of the messages taken by .receive_messages,
+        # received without blocking the listener
+        self._buffers = _Buffer_Receives()
+        # ring name -> the shared memory rings written to by the channels of
+        # the other ranks of the node, set at build time
+        self._rings: dict[str, _Ring_Reader] = {}
+        # channels holding back an advance or items until no message is waiting,
+        # shared by the workers of the "executor" mode
+        self._deferred_advances: set[_Channel] = set()
+        self._deferred_lock = threading.Lock()
+        self._deferred_for = 0
+        self._handlers: dict[int, Callable[[Any], None]] = {
+            STM_Msg.SHUTDOWN: self._handle_shutdown,
+            STM_Msg.CONSUME: self._handle_consume,
+            STM_Msg.ADVANCE: self._handle_advance,
+            STM_Msg.PUT: self._handle_put,
+            STM_Msg.PUT_BATCH: self._handle_put_batch,
+            STM_Msg.DATA: self._handle_data,
+            STM_Msg.DATA_BATCH: self._handle_data_batch,
+            STM_Msg.RELAY: self._handle_relay,
+            STM_Msg.BUFFERS: self._handle_buffers,
+            STM_Msg.SHARED: self._handle_shared,
+            STM_Msg.SUBSCRIBE: self._handle_subscribe,
+        }
 
     def __enter__(self):
         self.start()
@@ -39,37 +119,253 @@ class _STM:
         self.stop()
 
     def get_reader(self, name: str):
+        if name in self._sharded_readers:
+            return self._sharded_readers[name]
         return self._readers_by_id[name]
 
     def get_writer(self, name: str):
+        if name in self._sharded_writers:
+            return self._sharded_writers[name]
         return self._writers_by_id[name]
 
-    def start(self, listening_mode: Literal["thread", "manual"] = "thread"):
+    def _set_comm(self, comm: _STM_Comm):
+        self._comm = comm
+        self._requests.comm = comm
+        for channel in self._local_channels.values():
+            channel._requests.comm = comm
+            for link in channel.links.values():
+                link.init(comm.links)
+        for reader in self._readers_by_id.values():
+            reader._requests.comm = comm
+        for writer in self._writers_by_id.values():
+            writer._requests.comm = comm
+            if writer.link is not None:
+                writer.link.init(comm.links)
+        self._links.init(comm.links)
+
+    def start(
+        self,
+        listening_mode: Literal["thread", "manual", "executor"] = "thread",
+        n_workers: int | None = None,
+    ):
         if listening_mode == "thread":
             self._listening_thread = threading.Thread(
                 target=self._receive_message_loop,
-                args=(self.process_message,),
+                args=(self.process_messages,),
             )
             self._listening_thread.start()
         elif listening_mode == "manual":
             pass
+        elif listening_mode == "executor":
+            if n_workers is None:
+                n_workers = os.cpu_count() or 1
+            if n_workers < 1:
+                raise ValueError("n_workers must be at least 1")
+            # the channels hosted or read by this rank
+            channel_ids = sorted(self._channels_by_id.keys() | self._readers_by_channel)
+            self._executor = _Channel_Executor(
+                n_workers, self.process_messages, channel_ids
+            )
+            self._listening_thread = threading.Thread(
+                target=self._receive_message_loop,
+                args=(self._dispatch_messages, self._executor),
+            )
+            self._listening_thread.start()
         else:
             raise ValueError("Invalid listening_mode")
 
     def stop(self):
-        shutdown_msg = _Message_STM_Shutdown(source_rank=RANK)
+        # every message sent by the local connections is delivered before the
+        # shutdown, so no request or send buffer outlives the STM instance
+        for writer in self._writers_by_id.values():
+            writer.wait_all()
+        for reader in self._readers_by_id.values():
+            reader.wait_all()
+        self._flusher.stop()
+        shutdown_msg = encode_control(_Message_STM_Shutdown(source_rank=RANK))
         for target in range(SIZE):
-            COMM.send(obj=shutdown_msg, dest=target, tag=STM_Tag.STM_DATA)
+            self._comm.msgs.Send(
+                [shutdown_msg, MPI.BYTE], dest=target, tag=STM_Tag.STM_DATA
+            )
+        # nothing is sent or received on the communicators of the instance
+        # once the listener is done. In manual mode, the caller runs it.
+        if self._listening_thread is not None:
+            self._listening_thread.join()
+            if self._comm is not WORLD:
+                self._comm.free()
+                self._comm = WORLD
+        if self._executor is not None and self._executor.error is not None:
+            raise self._executor.error
+
+    def _receive_message_loop(
+        self,
+        handler: Callable[[list[Any]], None],
+        executor: _Channel_Executor | None = None,
+    ):
+        shutdown = False
+        while not shutdown:
+            msgs = self.receive_messages()
+            for msg in msgs:
+                shutdown = self.check_shutdown(msg)
+            handler(msgs)
+        # records that arrived along with the last shutdown
+        if self._links:
+            msgs, _ = self._links.receive()
+            handler(msgs)
+        if executor is not None:
+            executor.shutdown()
+        self.wait_all()
+        self._close_links()
+
+    # the persistent requests are freed once nothing is sent on them anymore,
+    # receives still posted are cancelled
+    def _close_links(self):
+        for writer in self._writers_by_id.values():
+            if writer.link is not None:
+                writer.link.wait_all()
+                writer.link.free()
+        for channel in self._local_channels.values():
+            for link in channel.links.values():
+                link.free()
+        self._links.close()
+
+    # hands the messages of the listener to the workers of the "executor"
+    # mode. Relays are forwarded here, so the pool of relay sends is only
+    # used by the listener thread, and messages are read from the shared
+    # memory rings here, in the order they were written.
+    def _dispatch_messages(self, msgs: list[Any]):
+        for msg in msgs:
+            self._dispatch(msg)
+
+    def _dispatch(self, msg: Any):
+        if msg.TYPE == STM_Msg.SHUTDOWN:
+            return
+        if msg.TYPE == STM_Msg.RELAY:
+            fan_out(msg.msg, msg.ranks, msg.fanout, self._requests)
+            self._dispatch(msg.msg)
+        elif msg.TYPE == STM_Msg.SHARED:
+            self._dispatch(self._rings[msg.name].read(msg))
+        else:
+            self._executor.submit(msg.channel_id, msg)
+
+    # waits until every message sent by the local channels, or relayed by
+    # this rank, has been delivered
+    def wait_all(self):
+        for channel in self._local_channels.values():
+            channel.wait_all()
+        self._requests.wait_all()
+        # a last call, with the final counts
+        if self._stats_hooks:
+            self._stats_hooks.run(self.stats, force=True)
+
+    # counters of this rank and of the channels it hosts or reads
+    def stats(self) -> dict[str, Any]:
+        pools = [self._requests]
+        pools += [channel._requests for channel in self._local_channels.values()]
+        pools += [reader._requests for reader in self._readers_by_id.values()]
+        pools += [writer._requests for writer in self._writers_by_id.values()]
+        channel_names = {
+            channel_id: name for name, channel_id in self._channel_ids.items()
+        }
+        channels: dict[str, dict[str, Any]] = {}
+        for name, channel in self._local_channels.items():
+            channels[name] = {"channel": channel.stats()}
+            if channel.local_readers:
+                channels[name]["readers"] = channel.local_readers.stats()
+        for channel_id, readers in self._readers_by_channel.items():
+            channels[channel_names[channel_id]] = {"readers": readers.stats()}
+        queue_depth = self._receive_stats.last_batch
+        if self._executor is not None:
+            queue_depth += self._executor.pending()
+        return {
+            "rank": RANK,
+            "messages_received": self._receive_stats.messages,
+            "bytes_received": self._receive_stats.bytes,
+            "messages_sent": sum(pool.messages_sent for pool in pools),
+            "bytes_sent": sum(pool.bytes_sent for pool in pools),
+            "outstanding_requests": sum(len(pool) for pool in pools),
+            "outstanding_bytes": sum(pool.nbytes for pool in pools),
+            "queue_depth": queue_depth,
+            "max_batch": self._receive_stats.max_batch,
+            "channels": channels,
+        }
+
+    # writes the state of this rank to its file in the directory `path`: the
+    # keeptimes and advancetimes of its channels and connections, and the
+    # items held by its readers. Items buffered by writers or still in flight
+    # are not part of it.
+    def checkpoint(self, path: str):
+        write_checkpoint(path, RANK, self._checkpoint_records())
+
+    # (kind, obj, ts) records, every store is locked while its items are written
+    def _checkpoint_records(self):
+        channel_names = sorted(self._channel_ids, key=self._channel_ids.get)
+        yield Checkpoint_Record.HEADER, {
+            "rank": RANK,
+            "ranks": SIZE,
+            "channels": channel_names,
+        }
+        for name, channel in self._local_channels.items():
+            with channel._lock:
+                yield Checkpoint_Record.CHANNEL, (
+                    name,
+                    dict(channel._readers_keeptime),
+                    dict(channel._writers_advancetime),
+                )
+        stores = [
+            (name, channel.local_readers)
+            for name, channel in self._local_channels.items()
+        ]
+        stores += [
+            (channel_names[channel_id], readers)
+            for channel_id, readers in self._readers_by_channel.items()
+        ]
+        for name, readers in stores:
+            if not readers:
+                continue
+            with readers.data.lock:
+                times = {
+                    reader.name: (reader.keeptime, reader.channel_advancetime)
+                    for reader in readers
+                }
+                yield Checkpoint_Record.READERS, (name, times)
+                for ts, item in readers.data.items():
+                    yield Checkpoint_Record.ITEM, item, ts
+        yield Checkpoint_Record.WRITERS, {
+            name: writer.advancetime for name, writer in self._writers_by_id.items()
+        }
+
+    # `hook` is called with the dict of .stats by the thread receiving
+    # messages, at most once every `interval` seconds, and by .wait_all
+    def add_stats_hook(self, hook: Callable[[dict], None], interval: float = 1.0):
+        self._stats_hooks.add(hook, interval)
 
-    def _receive_message_loop(self, handler: Callable[[Any], None]):
-        while True:
-            msg = self.receive_message().wait()
-            if self.check_shutdown(msg):
-                break
-            handler(msg)
+    def remove_stats_hook(self, hook: Callable[[dict], None]):
+        self._stats_hooks.remove(hook)
 
-    def receive_message(self) -> MPI.Request:
-        return COMM.irecv(tag=STM_Tag.STM_DATA)
+    def receive_message(self) -> _Message_Request:
+        if self._stats_hooks:
+            self._stats_hooks.run(self.stats)
+        return _Message_Request(self._comm, self._receive_stats)
+
+    # messages that have already arrived are returned as a single batch,
+    # waiting up to `timeout` seconds (forever if None) when there are none.
+    # Control messages are taken ahead of the data waiting in the queue, and
+    # messages with large buffers are returned once their buffers arrived.
+    def receive_messages(
+        self, max_n: int = 64, timeout: float | None = None
+    ) -> list[Any]:
+        msgs = receive_messages(
+            self._comm,
+            max_n,
+            timeout,
+            self._receive_stats,
+            self._links,
+            self._buffers,
+        )
+        if self._stats_hooks:
+            self._stats_hooks.run(self.stats)
+        return msgs
 
     def check_shutdown(self, msg: Any):
         if isinstance(msg, _Message_STM_Shutdown):
@@ -82,32 +378,143 @@ class _STM:
             return True
         return False
 
+    # channels coalescing advances send at most one per burst of messages
+    FLUSH_ADVANCES_AFTER = 64
+
     def process_message(self, msg):
-        logger.info(f"({RANK}) received {msg}")
-        if isinstance(msg, _Message_Channel_Put):
-            self._put(msg.ts, msg.item, msg.channel_name)
-        elif isinstance(msg, _Message_Reader_Data):
-            for reader in self._readers_by_channel.get(msg.channel_name, []):
-                reader.data[msg.ts] = msg.item
-        elif isinstance(msg, _Message_Reader_Consume):
-            channel = self._local_channels[msg.channel_name]
-            channel.handle_consume_until(msg.reader_name, msg.until)
-        elif isinstance(msg, _Message_Writer_Advance):
-            if msg.channel_name in self._local_channels:
-                channel = self._local_channels[msg.channel_name]
-                channel.handle_advance_until(msg.writer_name, msg.until)
-                return
-            for reader in self._readers_by_channel[msg.channel_name]:
-                reader.channel_advancetime = max(reader.channel_advancetime, msg.until)
-
-    def _put(self, ts: int, item: Any, channel_name: str):
-        if channel_name in self._local_channels:
-            channel = self._local_channels[channel_name]
-            channel.publish_data(ts, item)
+        self._process_message(msg)
+        if not self._deferred_advances:
+            return
+        self._deferred_for += 1
+        if (
+            self._deferred_for < self.FLUSH_ADVANCES_AFTER
+            and self._comm.msgs.Iprobe()
+        ):
+            return
+        self._flush_advances()
+
+    # processes a batch from .receive_messages. Runs of data messages for the
+    # same channel are stored with a single update of the readers, and
+    # coalesced advances are sent once for the whole batch.
+    def process_messages(self, msgs: list[Any]):
+        start = 0
+        while start < len(msgs):
+            msg = msgs[start]
+            end = start + 1
+            if msg.TYPE == STM_Msg.DATA:
+                while (
+                    end < len(msgs)
+                    and msgs[end].TYPE == STM_Msg.DATA
+                    and msgs[end].channel_id == msg.channel_id
+                ):
+                    end += 1
+            if end - start > 1:
+                self._handle_data_run(msgs[start:end])
+            else:
+                self._process_message(msg)
+            start = end
+        if self._deferred_advances:
+            self._flush_advances()
+
+    def _flush_advances(self):
+        with self._deferred_lock:
+            channels = list(self._deferred_advances)
+            self._deferred_advances.clear()
+            self._deferred_for = 0
+        for channel in channels:
+            channel.flush_advance()
+
+    # the items held by latest-value channels are sent along with the
+    # coalesced advances, once per burst of messages
+    def _defer_advance(self, channel: _Channel):
+        if not channel.has_pending_advance and not channel.has_held_items:
+            return
+        if channel.coalesce_advances or channel.has_held_items:
+            with self._deferred_lock:
+                self._deferred_advances.add(channel)
         else:
-            # todo: this can be removed once we have proper checks in the .build phase
-            if channel_name not in self._channel_rank:
-                raise ValueError(f"Unknown channel {channel_name}")
-            msg = _Message_Channel_Put(ts, item, RANK, channel_name)
-            channel_rank = self._channel_rank[channel_name]
-            COMM.send(obj=msg, dest=channel_rank, tag=STM_Tag.STM_DATA)
+            channel.flush_advance()
+
+    def _process_message(self, msg):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"({RANK}) received {msg}")
+        self._handlers[msg.TYPE](msg)
+
+    def _handle_shutdown(self, msg: _Message_STM_Shutdown):
+        # handled by .check_shutdown
+        pass
+
+    def _handle_buffers(self, msg: _Message_Buffers):
+        self._process_message(receive_buffers(msg, self._comm, self._receive_stats))
+
+    def _handle_relay(self, msg: _Message_Relay):
+        fan_out(msg.msg, msg.ranks, msg.fanout, self._requests)
+        self._process_message(msg.msg)
+
+    def _handle_shared(self, msg: _Message_Shared):
+        self._process_message(self._rings[msg.name].read(msg))
+
+    def _handle_put(self, msg: _Message_Channel_Put):
+        channel = self._channels_by_id[msg.channel_id]
+        channel.publish_data(msg.ts, msg.item, msg.writer_id, msg.advance, msg.put_time)
+        self._defer_advance(channel)
+
+    def _handle_put_batch(self, msg: _Message_Channel_Put_Batch):
+        channel = self._channels_by_id[msg.channel_id]
+        channel.publish_data_many(
+            msg.items, msg.writer_id, msg.advance, msg.put_time
+        )
+        self._defer_advance(channel)
+
+    def _handle_data(self, msg: _Message_Reader_Data):
+        readers = self._readers_by_channel.get(msg.channel_id)
+        if readers is None:
+            return
+        readers.receive_data(msg.ts, msg.item)
+        if msg.put_time is not None:
+            readers.latency.add(msg.put_time)
+        if msg.advance is not None:
+            readers.receive_advance(msg.advance)
+
+    def _handle_data_run(self, msgs: list[_Message_Reader_Data]):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"({RANK}) received {len(msgs)} data messages")
+        readers = self._readers_by_channel.get(msgs[0].channel_id)
+        if readers is None:
+            return
+        readers.receive_data_many([(msg.ts, msg.item) for msg in msgs], len(msgs))
+        for msg in msgs:
+            if msg.put_time is not None:
+                readers.latency.add(msg.put_time)
+        # advances can be applied late, only the highest one matters
+        advances = [msg.advance for msg in msgs if msg.advance is not None]
+        if advances:
+            readers.receive_advance(max(advances))
+
+    def _handle_data_batch(self, msg: _Message_Reader_Data_Batch):
+        readers = self._readers_by_channel.get(msg.channel_id)
+        if readers is None:
+            return
+        readers.receive_data_many(msg.items)
+        if msg.put_time is not None:
+            readers.latency.add(msg.put_time)
+        if msg.advance is not None:
+            readers.receive_advance(msg.advance)
+
+    def _handle_consume(self, msg: _Message_Reader_Consume):
+        channel = self._channels_by_id[msg.channel_id]
+        channel.handle_consume_until(msg.reader_id, msg.until)
+
+    def _handle_subscribe(self, msg: _Message_Reader_Subscribe):
+        channel = self._channels_by_id[msg.channel_id]
+        channel.set_subscription(msg.reader_id, msg.subscription)
+
+    def _handle_advance(self, msg: _Message_Writer_Advance):
+        if msg.channel_id in self._channels_by_id:
+            channel = self._channels_by_id[msg.channel_id]
+            channel.handle_advance_until(
+                msg.writer_id, msg.until, defer=True, seq=msg.seq
+            )
+            self._defer_advance(channel)
+            return
+        self._readers_by_channel[msg.channel_id].receive_advance(msg.until, msg.seq)
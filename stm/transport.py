@@ -0,0 +1,493 @@
+import itertools
+import pickle
+import time
+from collections import deque
+from mpi4py import MPI
+from typing import Any
+
+from .messaging import (
+    decode,
+    encode_control,
+    message_tag,
+    _Message_Buffers,
+    _Message_Relay,
+    STM_Msg,
+    STM_Tag,
+)
+from .links import _Receive_Links
+from .stats import _Receive_Stats
+
+
+COMM = MPI.COMM_WORLD
+RANK = COMM.Get_rank()
+
+
+class _STM_Comm:
+    """
+    The communicators an STM instance sends on, duplicated from COMM_WORLD
+    by STMBuilder.build so that STM traffic never matches the application's
+    own messages. Messages go on `msgs`, tagged STM_CONTROL or STM_DATA,
+    out-of-band buffers on `buffers`, and the records of persistent links
+    on `links`.
+
+    """
+
+    def __init__(self, msgs: MPI.Comm, buffers: MPI.Comm, links: MPI.Comm):
+        self.msgs = msgs
+        self.buffers = buffers
+        self.links = links
+
+    @classmethod
+    def dup(cls, comm: MPI.Comm) -> "_STM_Comm":
+        return cls(comm.Dup(), comm.Dup(), comm.Dup())
+
+    def free(self):
+        self.msgs.Free()
+        self.buffers.Free()
+        self.links.Free()
+
+
+# used until the communicators of the instance are set at build time
+WORLD = _STM_Comm(COMM, COMM, COMM)
+
+# buffer-protocol payloads (e.g. contiguous numpy arrays) at least this large
+# skip pickling and are moved with buffer-based sends instead
+OUT_OF_BAND_THRESHOLD = 64 * 1024
+
+# how long the listener polls persistent links without sleeping once they
+# are idle, and the longest it then sleeps between two polls. Links that had
+# no records for LINK_IDLE_AFTER seconds are polled like messages instead,
+# every POLL_BACKOFF seconds at most, without spinning.
+LINK_SPIN = 2e-4
+LINK_POLL_BACKOFF = 1e-4
+LINK_IDLE_AFTER = 1e-2
+POLL_BACKOFF = 1e-3
+
+# every message with out-of-band buffers gets its own tag, so that buffers
+# sent concurrently by several threads of the same rank cannot be mismatched
+_buffer_tags = itertools.count()
+
+
+class _Packed:
+    """
+    A message serialized once, which can then be sent to any number of ranks.
+
+    """
+
+    def __init__(self, msg: Any):
+        self.buffers: list[pickle.PickleBuffer] = []
+        self.tag = message_tag(msg)
+        data = encode_control(msg)
+        if data is not None:
+            self.data = data
+            return
+        self.data = pickle.dumps(msg, protocol=5, buffer_callback=self._out_of_band)
+        if self.buffers:
+            tag = STM_Tag.STM_BUFFER + next(_buffer_tags) % STM_Tag.STM_BUFFER_TAGS
+            sizes = [buf.raw().nbytes for buf in self.buffers]
+            header = _Message_Buffers(self.data, sizes, tag, RANK)
+            self.buffer_tag = tag
+            self.data = pickle.dumps(header, protocol=5)
+
+    def _out_of_band(self, buf: pickle.PickleBuffer) -> bool:
+        # returning a false value sends the buffer out-of-band
+        if buf.raw().nbytes < OUT_OF_BAND_THRESHOLD:
+            return True
+        self.buffers.append(buf)
+        return False
+
+    # the data is received and decoded by a _Message_Request
+    def isend(self, dest: int, comm: _STM_Comm) -> list[MPI.Request]:
+        reqs = [comm.msgs.Isend([self.data, MPI.BYTE], dest=dest, tag=self.tag)]
+        for buf in self.buffers:
+            reqs.append(
+                comm.buffers.Isend(
+                    [buf.raw(), MPI.BYTE], dest=dest, tag=self.buffer_tag
+                )
+            )
+        return reqs
+
+    # sizes of the sends made by .isend, in the same order as its requests
+    @property
+    def sizes(self) -> list[int]:
+        return [len(self.data)] + [buf.raw().nbytes for buf in self.buffers]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self.sizes)
+
+
+def isend(msg: Any, dest: int, comm: _STM_Comm) -> list[MPI.Request]:
+    return _Packed(msg).isend(dest, comm)
+
+
+class _Pending_Requests:
+    """
+    Keeps the requests (and so the buffers) of non-blocking sends alive
+    until they complete.
+
+    Completed requests are reaped with Testsome once REAP_AT requests were
+    added since the last reap, or once the pending requests doubled since
+    then if that takes longer, so each send costs amortized constant time.
+    If `max_requests` or `max_bytes` is set, adding sends past either cap
+    waits for earlier sends to complete (`block=True`), or raises
+    BlockingIOError without sending anything (`block=False`).
+    Sends go on `comm`, set at build time.
+
+    """
+
+    REAP_AT = 64
+
+    def __init__(
+        self,
+        max_requests: int | None = None,
+        max_bytes: int | None = None,
+        block: bool = True,
+    ):
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.block = block
+        self.comm = WORLD
+        self._reqs: list[MPI.Request] = []
+        self._sizes: list[int] = []
+        self._nbytes = 0
+        # the number of pending requests at which the next reap happens
+        self._reap_at = self.REAP_AT
+        # every message sent through the pool
+        self.messages_sent = 0
+        self.bytes_sent = 0
+
+    def __len__(self):
+        return len(self._reqs)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def _full(self, n_reqs: int, nbytes: int) -> bool:
+        # an empty pool always accepts, so a single oversized message can be sent
+        if not self._reqs:
+            return False
+        max_requests = self.max_requests
+        if max_requests is not None and len(self._reqs) + n_reqs > max_requests:
+            return True
+        if self.max_bytes is not None and self._nbytes + nbytes > self.max_bytes:
+            return True
+        return False
+
+    def _remove(self, done: list[int] | None):
+        if not done:
+            return
+        done_set = set(done)
+        self._nbytes -= sum(self._sizes[i] for i in done_set)
+        self._reqs = [r for i, r in enumerate(self._reqs) if i not in done_set]
+        self._sizes = [n for i, n in enumerate(self._sizes) if i not in done_set]
+
+    # makes room for sends of `nbytes` over `n_reqs` requests
+    def reserve(self, n_reqs: int, nbytes: int):
+        if len(self._reqs) + n_reqs >= self._reap_at:
+            self.reap()
+        if not self._full(n_reqs, nbytes):
+            return
+        self.reap()
+        if not self._full(n_reqs, nbytes):
+            return
+        if not self.block:
+            raise BlockingIOError(
+                f"{len(self._reqs)} sends ({self._nbytes} bytes) still pending"
+            )
+        while self._full(n_reqs, nbytes):
+            self._remove(MPI.Request.Waitsome(self._reqs))
+
+    # the requests of a single message
+    def add(self, reqs: list[MPI.Request], sizes: list[int] | None = None):
+        if sizes is None:
+            sizes = [0] * len(reqs)
+        self._reqs.extend(reqs)
+        self._sizes.extend(sizes)
+        self._nbytes += sum(sizes)
+        self.messages_sent += 1
+        self.bytes_sent += sum(sizes)
+        if len(self._reqs) >= self._reap_at:
+            self.reap()
+
+    # packs `msg` and sends it to `dest`, once there is room for it
+    def isend(self, msg: Any, dest: int):
+        packed = _Packed(msg)
+        sizes = packed.sizes
+        self.reserve(len(sizes), sum(sizes))
+        self.add(packed.isend(dest, self.comm), sizes)
+
+    def reap(self):
+        if self._reqs:
+            self._remove(MPI.Request.Testsome(self._reqs))
+        n_pending = len(self._reqs)
+        self._reap_at = n_pending + max(self.REAP_AT, n_pending)
+
+    def wait_all(self):
+        MPI.Request.Waitall(self._reqs)
+        self._reqs = []
+        self._sizes = []
+        self._nbytes = 0
+        self._reap_at = self.REAP_AT
+
+
+# sends `msg` to every rank in `ranks`. With a `fanout`, the message is only
+# sent to `fanout` ranks, each of them relaying it to an equal share of the
+# remaining ranks in the same way, so no rank does more than `fanout` sends
+def fan_out(
+    msg: Any, ranks: list[int], fanout: int | None, requests: _Pending_Requests
+):
+    if fanout is None or len(ranks) <= fanout:
+        # serialized once, the same buffers are sent to every rank
+        packed = _Packed(msg)
+        sizes = packed.sizes
+        for rank in ranks:
+            requests.reserve(len(sizes), sum(sizes))
+            requests.add(packed.isend(rank, requests.comm), sizes)
+        return
+    share = -(-len(ranks) // fanout)
+    for start in range(0, len(ranks), share):
+        rank, relay_ranks = ranks[start], ranks[start + 1 : start + share]
+        packed = _Packed(_Message_Relay(msg, relay_ranks, fanout))
+        sizes = packed.sizes
+        requests.reserve(len(sizes), sum(sizes))
+        requests.add(packed.isend(rank, requests.comm), sizes)
+
+
+class _Message_Request:
+    """
+    A receive of the next message on `comm`, used like the MPI.Request of a
+    pickle-based irecv. Messages are received with matched probes into a
+    buffer of their size, and decoded from either wire format. Control
+    messages are received ahead of data messages.
+
+    """
+
+    def __init__(self, comm: _STM_Comm, stats: _Receive_Stats | None = None):
+        self.comm = comm
+        self.stats = stats
+        self._message: MPI.Message | None = None
+        self._status = MPI.Status()
+
+    def get_status(self) -> bool:
+        if self._message is None:
+            self._message = _probe(self.comm, self._status)
+        return self._message is not None
+
+    def test(self) -> tuple[bool, Any]:
+        if not self.get_status():
+            return False, None
+        return True, self._receive()
+
+    def wait(self) -> Any:
+        if self._message is None:
+            self._message = self.comm.msgs.Mprobe(status=self._status)
+        return self._receive()
+
+    def _receive(self) -> Any:
+        message, self._message = self._message, None
+        return _receive(message, self._status, self.stats)
+
+
+def _probe(comm: _STM_Comm, status: MPI.Status) -> MPI.Message | None:
+    message = comm.msgs.Improbe(tag=STM_Tag.STM_CONTROL, status=status)
+    if message is None:
+        message = comm.msgs.Improbe(tag=STM_Tag.STM_DATA, status=status)
+    return message
+
+
+def _receive(
+    message: MPI.Message, status: MPI.Status, stats: _Receive_Stats | None
+) -> Any:
+    buf = bytearray(status.Get_count(MPI.BYTE))
+    message.Recv([buf, MPI.BYTE])
+    if stats is not None:
+        stats.messages += 1
+        stats.bytes += len(buf)
+    return decode(buf)
+
+
+class _Buffer_Receives:
+    """
+    The out-of-band buffers the listener is receiving, with non-blocking
+    receives, so that it goes on serving the messages of other ranks and
+    control messages while large buffers arrive. A message is returned once
+    all its buffers have arrived. Data messages from a rank are returned in
+    the order they were sent, those arriving after a message whose buffers
+    are still on their way wait for it, as they may carry advances past it.
+
+    """
+
+    def __init__(self):
+        self._reqs: list[MPI.Request] = []
+        # the entry of the message each request receives a buffer of
+        self._entries: list[list] = []
+        # source rank -> the data messages still waiting, in the order they
+        # were sent, as entries [message, buffers, receives left]
+        self._queues: dict[int, deque[list]] = {}
+
+    def __bool__(self):
+        return bool(self._queues)
+
+    # appends `msg` to `msgs`, unless it has out-of-band buffers, or is a data
+    # message of a rank with a message still receiving them
+    def add(self, msg: Any, status: MPI.Status, comm: _STM_Comm, msgs: list[Any]):
+        source = status.Get_source()
+        queue = self._queues.get(source)
+        if msg.TYPE == STM_Msg.BUFFERS:
+            buffers = [bytearray(size) for size in msg.buffer_sizes]
+            entry = [msg, buffers, len(buffers)]
+            for buf in buffers:
+                self._reqs.append(
+                    comm.buffers.Irecv(
+                        [buf, MPI.BYTE], source=msg.source_rank, tag=msg.buffer_tag
+                    )
+                )
+                self._entries.append(entry)
+            if queue is None:
+                queue = self._queues[source] = deque()
+            queue.append(entry)
+        elif queue is not None and status.Get_tag() == STM_Tag.STM_DATA:
+            queue.append([msg, None, 0])
+        else:
+            msgs.append(msg)
+
+    # the messages that are no longer waiting for buffers
+    def receive(self, stats: _Receive_Stats | None = None) -> list[Any]:
+        if not self._reqs:
+            return []
+        done = MPI.Request.Testsome(self._reqs)
+        if not done:
+            return []
+        done_set = set(done)
+        for i in done_set:
+            self._entries[i][2] -= 1
+        self._reqs = [r for i, r in enumerate(self._reqs) if i not in done_set]
+        self._entries = [e for i, e in enumerate(self._entries) if i not in done_set]
+        msgs = []
+        for source, queue in list(self._queues.items()):
+            while queue and queue[0][2] == 0:
+                msg, buffers, _ = queue.popleft()
+                if buffers is not None:
+                    if stats is not None:
+                        stats.bytes += sum(msg.buffer_sizes)
+                    msg = pickle.loads(msg.data, buffers=buffers)
+                msgs.append(msg)
+            if not queue:
+                del self._queues[source]
+        return msgs
+
+
+# waits up to `timeout` seconds (forever if None) for a message on `comm`,
+# then returns it along with every message that has already arrived,
+# up to `max_n` messages. Waiting control messages are taken first.
+# The records that arrived on persistent `links` are returned as messages
+# too, there is no blocking probe for them so they are polled for.
+# With `buffers`, messages with out-of-band buffers are only returned once
+# their buffers have arrived, see _Buffer_Receives.
+def receive_messages(
+    comm: _STM_Comm,
+    max_n: int,
+    timeout: float | None,
+    stats: _Receive_Stats | None = None,
+    links: _Receive_Links | None = None,
+    buffers: _Buffer_Receives | None = None,
+) -> list[Any]:
+    if buffers is None:
+        return _receive_batch(comm, max_n, timeout, stats, links, buffers)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        msgs = _receive_batch(comm, max_n, timeout, stats, links, buffers)
+        # a batch can be empty while buffers are still on their way
+        if msgs or not buffers:
+            return msgs
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return msgs
+
+
+def _receive_batch(
+    comm: _STM_Comm,
+    max_n: int,
+    timeout: float | None,
+    stats: _Receive_Stats | None,
+    links: _Receive_Links | None,
+    buffers: _Buffer_Receives | None,
+) -> list[Any]:
+    status = MPI.Status()
+    message = _probe(comm, status)
+    msgs, nbytes = links.receive() if links else ([], 0)
+    # messages whose buffers have arrived, already counted in `stats`
+    ready = buffers.receive(stats) if buffers else []
+    if message is None and not msgs and not ready:
+        if timeout is None and not links and not buffers:
+            # only STM_CONTROL and STM_DATA messages are sent on comm.msgs
+            message = comm.msgs.Mprobe(status=status)
+        elif timeout is None or timeout > 0:
+            # there is no timed probe, poll with a growing backoff. Links are
+            # latency bound, after recent records they are polled without
+            # sleeping for LINK_SPIN seconds (only yielding the GIL), then
+            # more often than messages until they go idle. Buffers on their
+            # way only progress while they are tested, they are polled
+            # without sleeping until they arrive.
+            now = time.monotonic()
+            deadline = None if timeout is None else now + timeout
+            active_until = links.received_at + LINK_IDLE_AFTER if links else now
+            spin_until = min(now + LINK_SPIN, active_until)
+            backoff = 1e-5
+            while message is None and not msgs and not ready:
+                now = time.monotonic()
+                sleep = 0.0 if now < spin_until or buffers else backoff
+                if deadline is not None:
+                    if now >= deadline:
+                        break
+                    sleep = min(sleep, deadline - now)
+                time.sleep(sleep)
+                if sleep:
+                    active = now < active_until
+                    max_backoff = LINK_POLL_BACKOFF if active else POLL_BACKOFF
+                    backoff = min(backoff * 2, max_backoff)
+                message = _probe(comm, status)
+                if links:
+                    msgs, nbytes = links.receive()
+                if buffers:
+                    ready = buffers.receive(stats)
+    if stats is not None:
+        stats.messages += len(msgs)
+        stats.bytes += nbytes
+    # ahead of the messages received below, which may come after them
+    msgs.extend(ready)
+    # a matched probe must be received, whatever the number of messages
+    while message is not None:
+        msg = _receive(message, status, stats)
+        if buffers is None:
+            msgs.append(msg)
+        else:
+            buffers.add(msg, status, comm, msgs)
+        if len(msgs) >= max_n:
+            break
+        message = _probe(comm, status)
+    if buffers:
+        msgs.extend(buffers.receive(stats))
+    if stats is not None:
+        stats.add_batch(len(msgs))
+    return msgs
+
+
+# receives the out-of-band buffers announced by `header` and rebuilds the
+# original message on top of them, without copying
+def receive_buffers(
+    header: _Message_Buffers, comm: _STM_Comm, stats: _Receive_Stats | None = None
+) -> Any:
+    buffers = []
+    for size in header.buffer_sizes:
+        buf = bytearray(size)
+        comm.buffers.Recv(
+            [buf, MPI.BYTE], source=header.source_rank, tag=header.buffer_tag
+        )
+        buffers.append(buf)
+    if stats is not None:
+        stats.bytes += sum(header.buffer_sizes)
+    return pickle.loads(header.data, buffers=buffers)
@@ -0,0 +1,21 @@
+# a batch that fails must not take its worker down with it
+from stm.executor import _Channel_Executor
+
+
+def test_worker_survives_a_failed_batch():
+    processed = []
+
+    def process(msgs):
+        if "bad" in msgs:
+            raise RuntimeError("bad message")
+        processed.extend(msgs)
+
+    executor = _Channel_Executor(1, process, [7])
+    executor.submit(7, "bad")
+    # the first batch is taken before the next message is submitted
+    while executor.pending():
+        pass
+    executor.submit(7, "good")
+    executor.shutdown()
+    assert processed == ["good"]
+    assert isinstance(executor.error, RuntimeError)
@@ -0,0 +1,74 @@
+# waits on items the store drops again must still end with the advance past
+# them, not at their timeout
+import asyncio
+import threading
+import time
+
+import numpy
+
+from stm.connection import _Local_Readers, _Reader
+from stm.data import _Ring_Spec
+
+
+def _readers(**kwargs) -> tuple[_Local_Readers, _Reader]:
+    readers = _Local_Readers(**kwargs)
+    reader = _Reader("reader", "channel", 0, readers.data)
+    readers.add(reader)
+    return readers, reader
+
+
+def _blocked_get(reader: _Reader, ts: int) -> tuple[threading.Thread, dict]:
+    result = {}
+
+    def get():
+        start = time.monotonic()
+        result["item"] = reader.get(ts, wait=True, timeout=5)
+        result["elapsed"] = time.monotonic() - start
+
+    thread = threading.Thread(target=get)
+    thread.start()
+    while ts not in reader._waiters:
+        time.sleep(1e-3)
+    return thread, result
+
+
+def test_get_evicted_by_the_same_batch():
+    readers, reader = _readers(keep_last=1)
+    thread, result = _blocked_get(reader, 5)
+    readers.receive_data_many([(5, "five"), (6, "six")])
+    time.sleep(0.05)
+    readers.receive_advance(20)
+    thread.join()
+    assert result["item"] == (None, False)
+    assert result["elapsed"] < 1
+    assert not reader._waiters and not reader._waiting_ts
+
+
+def test_get_async_evicted_by_the_same_batch():
+    readers, reader = _readers(keep_last=1)
+
+    async def main():
+        task = asyncio.create_task(reader.get_async(5, timeout=5))
+        while 5 not in reader._futures:
+            await asyncio.sleep(1e-3)
+        readers.receive_data_many([(5, "five"), (6, "six")])
+        await asyncio.sleep(0.05)
+        assert not task.done()
+        readers.receive_advance(20)
+        return await asyncio.wait_for(task, 1)
+
+    assert asyncio.run(main()) == (None, False)
+
+
+def test_get_overwritten_in_a_ring():
+    readers, reader = _readers(ring=_Ring_Spec("<f8", (), 4))
+    thread, result = _blocked_get(reader, 5)
+    # 10 is past the end of the ring from its head, and overwrites 5
+    readers.receive_data_many([(5, 5.0), (10, 10.0)])
+    time.sleep(0.05)
+    readers.receive_advance(20)
+    thread.join()
+    assert result["item"] == (None, False)
+    assert result["elapsed"] < 1
+    assert readers.data.n_overwritten == 1
+    assert numpy.array_equal(reader.get(10)[0], 10.0)